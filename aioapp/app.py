@@ -1,9 +1,12 @@
+import time
 import asyncio
 import signal
 import logging
-from typing import Dict, Optional, Callable
+from functools import partial
+from typing import Dict, Optional, Callable, Any
 from .error import PrepareError, GracefulExit
-from .tracer import Tracer, Span, SERVER
+from .tracer import Tracer, Span, SERVER, LOCAL_COMPONENT
+from .scheduler import Scheduler
 
 logger = logging.getLogger('aioapp')
 
@@ -35,6 +38,117 @@ class Component(object):
         raise NotImplementedError()
 
 
+class LoopMonitor(object):
+    """
+    Measures every callback and task step executed by the event loop and
+    emits a span for the ones running longer than `threshold` seconds.
+
+    Callbacks are wrapped when scheduled through call_soon, call_at
+    (call_later goes through it) and call_soon_threadsafe of the loop
+    instance. Steps of a task whose coroutine holds a `ctx` span are
+    reported in the trace of that span, other callbacks get a new trace.
+    """
+
+    def __init__(self, app: 'Application', threshold: float) -> None:
+        self.app = app
+        self.loop = app.loop
+        self.threshold = threshold
+        self._installed = False
+
+    def install(self) -> None:
+        if self._installed:
+            return
+        loop = self.loop
+        for meth in ('call_soon', 'call_soon_threadsafe', 'call_at'):
+            # call_at has a `when` positional argument before the callback
+            setattr(loop, meth, partial(self._schedule, getattr(loop, meth),
+                                        1 if meth == 'call_at' else 0))
+        self._installed = True
+
+    def uninstall(self) -> None:
+        if not self._installed:
+            return
+        for meth in ('call_soon', 'call_soon_threadsafe', 'call_at'):
+            delattr(self.loop, meth)
+        self._installed = False
+
+    def _schedule(self, orig: Callable, idx: int,
+                  *args: Any, **kwargs: Any) -> Any:
+        _args = list(args)
+        _args[idx] = partial(self._run, _args[idx])
+        return orig(*_args, **kwargs)
+
+    def _run(self, callback: Callable, *args: Any) -> Any:
+        task = getattr(callback, '__self__', None)
+        if isinstance(task, asyncio.Task):
+            # the step may finish the coroutine and drop its frame, the
+            # awaited ones are walked only for slow steps
+            coro = (task.get_coro() if hasattr(task, 'get_coro')
+                    else task._coro)
+            frame = (getattr(coro, 'cr_frame', None)
+                     or getattr(coro, 'gi_frame', None))
+        else:
+            task = frame = None
+        start = time.perf_counter()
+        try:
+            return callback(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            if elapsed >= self.threshold:
+                try:
+                    frames = None
+                    if task is not None:
+                        frames = self._frames(task) or (
+                            [frame] if frame is not None else [])
+                    self._report(callback, task, frames, elapsed)
+                except Exception as err:  # pragma: no cover
+                    self.app.log_err(err)
+
+    @staticmethod
+    def _frames(task: asyncio.Task) -> list:
+        frames = []
+        coro = task.get_coro() if hasattr(task, 'get_coro') else task._coro
+        while coro is not None:
+            frame = (getattr(coro, 'cr_frame', None)
+                     or getattr(coro, 'gi_frame', None))
+            if frame is None:
+                break
+            frames.append(frame)
+            coro = (getattr(coro, 'cr_await', None)
+                    or getattr(coro, 'gi_yieldfrom', None))
+        return frames
+
+    def _report(self, callback: Callable, task: Optional[asyncio.Task],
+                frames: Optional[list], elapsed: float) -> None:
+        ctx = None
+        if task is not None:
+            coro = task.get_coro() if hasattr(task, 'get_coro') else task._coro
+            name = 'loop:task'
+            qualname = getattr(coro, '__qualname__', repr(coro))
+            # the innermost coroutine holding a span wins
+            for frame in reversed(frames or []):
+                val = frame.f_locals.get('ctx')
+                if isinstance(val, Span):
+                    ctx = val
+                    break
+        else:
+            name = 'loop:callback'
+            func = callback
+            while isinstance(func, partial):
+                func = func.func
+            qualname = getattr(func, '__qualname__', repr(func))
+
+        if ctx is not None:
+            span = ctx.new_child()
+        else:
+            span = self.app.tracer.new_trace()
+        now = time.time()
+        span.start(ts=now - elapsed)
+        span.name(name)
+        span.tag(LOCAL_COMPONENT, qualname)
+        span.finish(ts=now)
+
+
 class Application(object):
     def __init__(self, loop=None, on_start: Optional[Callable] = None) -> None:
         super(Application, self).__init__()
@@ -44,6 +158,8 @@ class Application(object):
         self._stopped: list = []
         self.tracer: Tracer = Tracer(self, self.loop)
         self.on_start: Optional[Callable] = on_start
+        self.loop_monitor: Optional[LoopMonitor] = None
+        self.scheduler: Scheduler = Scheduler(self.loop, self.tracer)
 
     def add(self, name: str, comp: Component,
             stop_after: list = None):
@@ -89,7 +205,17 @@ class Application(object):
                       tracer_default_debug: bool = False,
                       metrics_driver=None, metrics_addr=None,
                       metrics_name=None,
-                      on_span_finish: Optional[Callable] = None):
+                      metrics_max_packet_size: int = 1432,
+                      metrics_flush_interval: float = 0.1,
+                      metrics_aggregate: bool = False,
+                      metrics_aggregate_interval: float = 10.,
+                      metrics_max_tag_values: Optional[int] = None,
+                      metrics_stats_interval: Optional[float] = None,
+                      metrics_sample_rate: float = 1.,
+                      on_span_finish: Optional[Callable] = None,
+                      profiler_threshold: Optional[float] = None,
+                      profiler_interval: float = 0.005,
+                      profiler_dump_dir: Optional[str] = None):
         if tracer_driver:
             self.tracer.setup_tracer(tracer_driver, tracer_name, tracer_addr,
                                      tracer_sample_rate, tracer_send_inteval,
@@ -97,9 +223,27 @@ class Application(object):
                                      tracer_default_debug)
         if metrics_driver:
             self.tracer.setup_metrics(metrics_driver, metrics_addr,
-                                      metrics_name)
+                                      metrics_name,
+                                      max_packet_size=metrics_max_packet_size,
+                                      flush_interval=metrics_flush_interval,
+                                      aggregate=metrics_aggregate,
+                                      aggregate_interval=(
+                                          metrics_aggregate_interval),
+                                      max_tag_values=metrics_max_tag_values,
+                                      stats_interval=metrics_stats_interval,
+                                      sample_rate=metrics_sample_rate)
+        if profiler_threshold is not None:
+            self.tracer.setup_profiler(profiler_threshold,
+                                       interval=profiler_interval,
+                                       dump_dir=profiler_dump_dir)
         self.tracer.on_span_finish = on_span_finish
 
+    def setup_loop_monitor(self, threshold: float = 0.1) -> None:
+        if self.loop_monitor is not None:
+            self.loop_monitor.uninstall()
+        self.loop_monitor = LoopMonitor(self, threshold)
+        self.loop_monitor.install()
+
     async def _shutdown_tracer(self):
         if self.tracer:
             self.log_info("Shutting down tracer")
@@ -161,6 +305,9 @@ class Application(object):
         self.log_info('Shutting down...')
         for comp_name in self._components:
             await self._stop_comp(comp_name)
+        self.scheduler.close()
+        if self.loop_monitor is not None:
+            self.loop_monitor.uninstall()
         await self._shutdown_tracer()
 
     async def _stop_comp(self, name):
@@ -8,3 +8,41 @@ class GracefulExit(SystemExit):
 
 class PrepareError(Error):
     pass
+
+
+class PoolError(Error):
+    pass
+
+
+class PoolClosedError(PoolError):
+    pass
+
+
+class PoolTimeoutError(PoolError):
+    pass
+
+
+class HttpError(Error):
+    """
+    Answered with `status` by the HTTP server
+    """
+
+    def __init__(self, status: int, message: str = '') -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class BulkheadError(Error):
+    pass
+
+
+class BulkheadFullError(BulkheadError):
+    pass
+
+
+class BulkheadTimeoutError(BulkheadError):
+    pass
+
+
+class CircuitOpenError(Error):
+    pass
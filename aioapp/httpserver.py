@@ -0,0 +1,354 @@
+import asyncio
+from http import HTTPStatus
+from typing import Optional, Dict, Callable, Any, Set, Tuple, Union
+from urllib.parse import unquote
+from .app import Component
+from .error import PrepareError, HttpError
+from .misc import json_encode_bytes
+from .prometheus import PrometheusExporter
+from .tracer import (Span, SERVER, HTTP_HOST, HTTP_METHOD, HTTP_PATH,
+                     HTTP_URL, HTTP_REQUEST_SIZE, HTTP_RESPONSE_SIZE,
+                     HTTP_STATUS_CODE, CLIENT_ADDR)
+
+REASONS = {status.value: status.phrase for status in HTTPStatus}
+
+
+class Request:
+    __slots__ = ('method', 'path', 'query', 'version', 'headers', 'body',
+                 'remote', 'route')
+
+    def __init__(self, method: str, path: str, query: str, version: str,
+                 headers: Dict[str, str],
+                 remote: Optional[Tuple] = None) -> None:
+        self.method = method
+        self.path = path
+        self.query = query
+        self.version = version
+        # lower case names
+        self.headers = headers
+        self.body = b''
+        self.remote = remote
+        self.route: Optional[str] = None
+
+    @property
+    def keep_alive(self) -> bool:
+        conn = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.1':
+            return conn != 'close'
+        return conn == 'keep-alive'
+
+
+class Response:
+    __slots__ = ('status', 'body', 'headers', 'content_type')
+
+    def __init__(self, body: Union[bytes, str] = b'', status: int = 200,
+                 headers: Optional[Dict[str, str]] = None,
+                 content_type: str = 'text/plain; charset=utf-8') -> None:
+        self.status = status
+        self.body = body.encode() if isinstance(body, str) else body
+        self.headers = headers
+        self.content_type = content_type
+
+    @classmethod
+    def json(cls, data: Any, status: int = 200,
+             headers: Optional[Dict[str, str]] = None) -> 'Response':
+        return cls(json_encode_bytes(data), status, headers,
+                   'application/json')
+
+
+Handler = Callable[[Span, Request], Any]
+
+
+class HttpServer(Component):
+    """
+    Minimal HTTP/1.1 server, listening on the loopback interface unless
+    another `host` is given.
+
+    Connections are kept alive and pipelined requests are answered in
+    order. The head of a request is limited to `max_head_size` bytes and
+    the body, given with Content-Length or chunked, to `max_body_size`.
+
+    Routes map an exact path and a method to `handler(ctx, request)`
+    returning a Response, HEAD is answered by GET handlers. Handlers may
+    raise HttpError to answer with its status. Every request is a
+    `http_in` server span continuing the trace of the request headers, with
+    method, route and status code also as metrics tags.
+
+    `health_path` answers with the result of `Application.health`, 503 if
+    a component is not healthy, and `metrics_path` with the tracer
+    registry in the Prometheus or OpenMetrics format. Both are not traced.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 8080,
+                 max_head_size: int = 8192,
+                 max_body_size: int = 1048576,
+                 read_timeout: float = 10.,
+                 keep_alive_timeout: float = 75.,
+                 health_path: Optional[str] = '/health',
+                 metrics_path: Optional[str] = '/metrics',
+                 metrics_prefix: str = '') -> None:
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.max_head_size = max_head_size
+        self.max_body_size = max_body_size
+        self.read_timeout = read_timeout
+        self.keep_alive_timeout = keep_alive_timeout
+        self.metrics_path = metrics_path
+        self.metrics_prefix = metrics_prefix
+        self.server: Optional[asyncio.AbstractServer] = None
+        self._routes: Dict[str, Dict[str, Tuple[Handler, bool]]] = {}
+        self._idle: Set[asyncio.StreamWriter] = set()
+        self._handlers: Set[asyncio.Task] = set()
+        self._closing = False
+        if health_path is not None:
+            self.add_route('GET', health_path, self._health, trace=False)
+        if metrics_path is not None:
+            self.add_route('GET', metrics_path, self._metrics, trace=False)
+
+    def add_route(self, method: str, path: str, handler: Handler,
+                  trace: bool = True) -> None:
+        methods = self._routes.setdefault(path, {})
+        method = method.upper()
+        if method in methods:
+            raise UserWarning('Route %s %s is already added' % (method, path))
+        methods[method] = (handler, trace)
+
+    async def prepare(self) -> None:
+        if self.app is None:
+            raise PrepareError('Component is not added to an application')
+        if self.metrics_path is not None and self.app.tracer.registry is None:
+            self.app.tracer.setup_registry(prefix=self.metrics_prefix)
+
+    async def start(self) -> None:
+        self._closing = False
+        self.server = await asyncio.start_server(
+            self._handle, self.host, self.port, loop=self.loop,
+            limit=self.max_head_size)
+
+    async def stop(self) -> None:
+        self._closing = True
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        # busy connections are closed after their response
+        for writer in list(self._idle):
+            writer.close()
+        if self._handlers:
+            _, pending = await asyncio.wait(self._handlers, loop=self.loop,
+                                            timeout=self.read_timeout)
+            for task in pending:
+                task.cancel()
+
+    async def health(self, ctx: Span) -> None:
+        if self.server is None:
+            raise Exception('HTTP server is not running')
+
+    async def _handle(self, reader: asyncio.StreamReader,
+                      writer: asyncio.StreamWriter) -> None:
+        remote = writer.get_extra_info('peername')
+        timeout = self.read_timeout
+        task = asyncio.Task.current_task(loop=self.loop)
+        self._handlers.add(task)
+        try:
+            while not self._closing:
+                self._idle.add(writer)
+                try:
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b'\r\n\r\n'), timeout,
+                        loop=self.loop)
+                except asyncio.LimitOverrunError:
+                    self._write_error(writer, 431)
+                    break
+                finally:
+                    self._idle.discard(writer)
+                timeout = self.keep_alive_timeout
+                try:
+                    request = self._parse_head(head, remote)
+                    await asyncio.wait_for(self._read_body(request, reader,
+                                                           writer),
+                                           self.read_timeout, loop=self.loop)
+                except HttpError as err:
+                    self._write_error(writer, err.status)
+                    break
+                response = await self._dispatch(request)
+                keep_alive = request.keep_alive and not self._closing
+                self._write(writer, response, keep_alive,
+                            request.method == 'HEAD')
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                ConnectionError):
+            pass
+        finally:
+            self._handlers.discard(task)
+            writer.close()
+
+    def _parse_head(self, head: bytes, remote: Optional[Tuple]) -> Request:
+        try:
+            lines = head.decode('latin-1').split('\r\n')
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            raise HttpError(400)
+        if version not in ('HTTP/1.1', 'HTTP/1.0'):
+            raise HttpError(505)
+        headers = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise HttpError(400)
+            headers[name.strip().lower()] = value.strip()
+        path, _, query = target.partition('?')
+        return Request(method, unquote(path), query, version, headers,
+                       remote)
+
+    async def _read_body(self, request: Request,
+                         reader: asyncio.StreamReader,
+                         writer: asyncio.StreamWriter) -> None:
+        headers = request.headers
+        chunked = headers.get('transfer-encoding', '').lower()
+        length = headers.get('content-length')
+        if not chunked and not length:
+            return
+        if headers.get('expect', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        if chunked:
+            if chunked != 'chunked':
+                raise HttpError(501)
+            request.body = await self._read_chunked(reader)
+            return
+        try:
+            size = int(length)
+        except ValueError:
+            raise HttpError(400)
+        if size < 0:
+            raise HttpError(400)
+        if size > self.max_body_size:
+            raise HttpError(413)
+        request.body = await reader.readexactly(size)
+
+    async def _read_chunked(self, reader: asyncio.StreamReader) -> bytes:
+        chunks = []
+        total = 0
+        while True:
+            line = await self._read_line(reader)
+            try:
+                size = int(line.split(b';', 1)[0], 16)
+            except ValueError:
+                raise HttpError(400)
+            if size < 0:
+                raise HttpError(400)
+            if size == 0:
+                # trailers are ignored
+                while await self._read_line(reader) != b'\r\n':
+                    pass
+                return b''.join(chunks)
+            total += size
+            if total > self.max_body_size:
+                raise HttpError(413)
+            try:
+                chunks.append(await reader.readexactly(size))
+                end = await reader.readexactly(2)
+            except asyncio.IncompleteReadError:
+                raise HttpError(400)
+            if end != b'\r\n':
+                raise HttpError(400)
+
+    async def _read_line(self, reader: asyncio.StreamReader) -> bytes:
+        try:
+            return await reader.readuntil(b'\r\n')
+        except asyncio.LimitOverrunError:
+            # a chunk size or trailer line longer than the head limit
+            raise HttpError(413)
+        except asyncio.IncompleteReadError:
+            raise HttpError(400)
+
+    async def _dispatch(self, request: Request) -> Response:
+        methods = self._routes.get(request.path)
+        route = None
+        if methods is not None:
+            route = methods.get(request.method)
+            if route is None and request.method == 'HEAD':
+                route = methods.get('GET')
+        ctx = self.app.tracer.new_trace_from_headers(
+            request.headers, skip=route is not None and not route[1])
+        ctx.name('http_in')
+        ctx.kind(SERVER)
+        ctx.tag(HTTP_METHOD, request.method, True)
+        ctx.tag(HTTP_PATH, request.path)
+        ctx.tag(HTTP_URL, request.path + ('?' + request.query
+                                          if request.query else ''))
+        ctx.tag(HTTP_HOST, request.headers.get('host', ''))
+        ctx.tag(HTTP_REQUEST_SIZE, len(request.body))
+        if request.remote:
+            ctx.tag(CLIENT_ADDR, request.remote[0])
+        ctx.start()
+        error = None
+        if route is None and methods:
+            allowed = set(methods)
+            if 'GET' in allowed:
+                allowed.add('HEAD')
+            response = Response(status=405, headers={
+                'Allow': ', '.join(sorted(allowed))})
+        elif route is None:
+            response = Response(status=404)
+        else:
+            request.route = request.path
+            ctx.metrics_tag('route', request.path)
+            try:
+                response = await route[0](ctx, request)
+                if not isinstance(response, Response):
+                    raise TypeError('Handler of %s %s returned %r instead of '
+                                    'a Response' % (request.method,
+                                                    request.path, response))
+            except HttpError as err:
+                response = Response(str(err), status=err.status)
+            except Exception as err:
+                self.app.log_err(err)
+                error = err
+                response = Response(status=500)
+        ctx.tag(HTTP_STATUS_CODE, response.status, True)
+        ctx.tag(HTTP_RESPONSE_SIZE, len(response.body))
+        ctx.finish(exception=error)
+        return response
+
+    def _write(self, writer: asyncio.StreamWriter, response: Response,
+               keep_alive: bool, head_only: bool = False) -> None:
+        status = response.status
+        lines = ['HTTP/1.1 %s %s' % (status, REASONS.get(status, '')),
+                 'Content-Type: %s' % response.content_type,
+                 'Content-Length: %s' % len(response.body),
+                 'Connection: %s' % ('keep-alive' if keep_alive
+                                     else 'close')]
+        if response.headers:
+            lines.extend('%s: %s' % item for item in response.headers.items())
+        lines.append('\r\n')
+        data = '\r\n'.join(lines).encode('latin-1')
+        if not head_only:
+            data += response.body
+        writer.write(data)
+
+    def _write_error(self, writer: asyncio.StreamWriter,
+                     status: int) -> None:
+        self._write(writer, Response(REASONS.get(status, ''), status), False)
+
+    async def _health(self, ctx: Span, request: Request) -> Response:
+        result = await self.app.health(ctx)
+        status = 200 if all(err is None for err in result.values()) else 503
+        return Response.json({name: None if err is None else str(err)
+                              for name, err in result.items()}, status)
+
+    async def _metrics(self, ctx: Span, request: Request) -> Response:
+        openmetrics = ('application/openmetrics-text'
+                       in request.headers.get('accept', ''))
+        registry = self.app.tracer.registry
+        return Response(registry.render(openmetrics)
+                        if registry is not None else '',
+                        content_type=(
+                            PrometheusExporter.openmetrics_content_type
+                            if openmetrics else
+                            PrometheusExporter.content_type))
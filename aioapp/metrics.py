@@ -0,0 +1,489 @@
+import re
+import math
+import time
+import random
+from bisect import bisect_left
+from typing import Dict, Tuple, List, Iterable, Optional, Any, Callable
+import aioapp.tracer  # noqa
+
+PROMETHEUS_NAME_RE = re.compile('[^a-zA-Z0-9_:]')
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5.,
+                   10.)
+
+# (escaped name, escaped tags joined with commas)
+SeriesKey = Tuple[str, str]
+
+
+class Exemplar:
+    __slots__ = ('trace_id', 'value', 'sampled', 'stamp')
+
+    def __init__(self, trace_id: str, value: float, sampled: bool,
+                 stamp: float) -> None:
+        self.trace_id = trace_id
+        self.value = value
+        self.sampled = sampled
+        self.stamp = stamp
+
+
+class Exemplars:
+    """
+    One exemplar trace per histogram bucket.
+
+    A new trace replaces the kept one if it is sampled while the kept one is
+    not, or is as slow or slower with the same sampling, or if the kept one
+    is older than `max_age` seconds, so exemplars point to traces which can
+    actually be found and stay recent.
+    """
+    __slots__ = ('slots',)
+
+    max_age = 60.
+
+    def __init__(self, size: int) -> None:
+        self.slots: List[Optional[Exemplar]] = [None] * size
+
+    def offer(self, idx: int, value: float, trace_id: str,
+              sampled: bool) -> None:
+        now = time.time()
+        cur = self.slots[idx]
+        if (cur is None or now - cur.stamp > self.max_age
+                or (sampled, value) >= (cur.sampled, cur.value)):
+            self.slots[idx] = Exemplar(trace_id, value, sampled, now)
+
+
+class TimerStats:
+    """
+    Summary of timer values: count, sum, min, max and percentiles
+    estimated from a fixed size uniform reservoir of values
+    """
+    __slots__ = ('count', 'sum', 'min', 'max', '_reservoir', '_size')
+
+    def __init__(self, reservoir_size: int = 256) -> None:
+        self.count = 0
+        self.sum = 0
+        self.min = 0
+        self.max = 0
+        self._reservoir: List[float] = []
+        self._size = reservoir_size
+
+    def add(self, value: float) -> None:
+        if self.count == 0:
+            self.min = self.max = value
+        elif value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+        self.count += 1
+        self.sum += value
+        if len(self._reservoir) < self._size:
+            self._reservoir.append(value)
+        else:
+            idx = int(random.random() * self.count)  # nosec
+            if idx < self._size:
+                self._reservoir[idx] = value
+
+    def percentiles(self, percentiles: Iterable[float]) -> List[float]:
+        # nearest-rank method
+        values = sorted(self._reservoir)
+        if not values:
+            return [0 for _ in percentiles]
+        size = len(values)
+        return [values[max(0, math.ceil(size * p / 100.) - 1)]
+                for p in percentiles]
+
+
+class Aggregator:
+    """
+    In-memory per-series counters, gauges and timers accumulated between
+    flushes. Timer values with a trace id also keep exemplars per
+    `exemplar_buckets` bucket
+    """
+
+    def __init__(self, reservoir_size: int = 256,
+                 exemplar_buckets: Iterable[float] = DEFAULT_BUCKETS
+                 ) -> None:
+        self.reservoir_size = reservoir_size
+        self.exemplar_buckets = sorted(exemplar_buckets)
+        self.counters: Dict[SeriesKey, float] = {}
+        self.gauges: Dict[SeriesKey, float] = {}
+        self.timers: Dict[SeriesKey, TimerStats] = {}
+        self.exemplars: Dict[SeriesKey, Exemplars] = {}
+
+    def count(self, key: SeriesKey, value: float = 1) -> None:
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, key: SeriesKey, value: float) -> None:
+        self.gauges[key] = value
+
+    def timer(self, key: SeriesKey, value: float,
+              trace_id: Optional[str] = None, sampled: bool = False) -> None:
+        stats = self.timers.get(key)
+        if stats is None:
+            stats = self.timers[key] = TimerStats(self.reservoir_size)
+        stats.add(value)
+        if trace_id is not None:
+            exemplars = self.exemplars.get(key)
+            if exemplars is None:
+                exemplars = self.exemplars[key] = Exemplars(
+                    len(self.exemplar_buckets) + 1)
+            exemplars.offer(bisect_left(self.exemplar_buckets, value), value,
+                            trace_id, sampled)
+
+    def reset(self) -> Tuple[Dict[SeriesKey, float],
+                             Dict[SeriesKey, float],
+                             Dict[SeriesKey, TimerStats]]:
+        """
+        Returns accumulated counters, gauges and timers and starts over.
+        Gauges keep their last value
+        """
+        counters, timers = self.counters, self.timers
+        self.counters = {}
+        self.timers = {}
+        return counters, dict(self.gauges), timers
+
+    def reset_exemplars(self) -> Dict[SeriesKey, Exemplars]:
+        exemplars = self.exemplars
+        self.exemplars = {}
+        return exemplars
+
+
+class Instrument:
+    """
+    Metric bound to a name and a tag set.
+
+    The series key is encoded once per InfluxMetrics instance and registry
+    of the tracer, so updates cost a dict update in aggregation mode or one
+    line otherwise.
+    Updates are also recorded in the tracer registry if there is one, and
+    are ignored while neither is set up.
+    """
+
+    def __init__(self, tracer: 'aioapp.tracer.Tracer', name: str,
+                 tags: Optional[dict] = None) -> None:
+        self.tracer = tracer
+        self.name = name
+        self.tags = dict(tags) if tags else {}
+        self._metrics: Any = None
+        self._key: Optional[SeriesKey] = None
+        self._registry: Optional[Registry] = None
+        self._registry_key: Optional[RegistryKey] = None
+
+    def _bind(self) -> Any:
+        metrics = self.tracer.metrics
+        if metrics is not self._metrics:
+            self._metrics = metrics
+            self._key = (metrics.series_key(self.name, self.tags)
+                         if metrics is not None else None)
+        return metrics
+
+    def _bind_registry(self) -> Optional['Registry']:
+        registry = self.tracer.registry
+        if registry is not self._registry:
+            self._registry = registry
+            self._registry_key = (registry.series_key(self.name, self.tags)
+                                  if registry is not None else None)
+        return registry
+
+
+class Counter(Instrument):
+
+    def inc(self, value: float = 1) -> None:
+        metrics = self._bind()
+        if metrics is not None:
+            metrics.count(self._key, value)
+        registry = self._bind_registry()
+        if registry is not None:
+            registry.count(self._registry_key, value)
+
+
+class Gauge(Instrument):
+
+    def set(self, value: float) -> None:
+        metrics = self._bind()
+        if metrics is not None:
+            metrics.gauge(self._key, value)
+        registry = self._bind_registry()
+        if registry is not None:
+            registry.gauge(self._registry_key, value)
+
+
+class Histogram(Instrument):
+
+    def observe(self, value: float,
+                ctx: Optional['aioapp.tracer.Span'] = None) -> None:
+        """
+        :param ctx: span to keep as exemplar of the value
+        """
+        metrics = self._bind()
+        if metrics is not None:
+            metrics.histogram(self._key, value)
+        registry = self._bind_registry()
+        if registry is not None:
+            if ctx is not None:
+                registry.observe(self._registry_key, value, ctx.trace_id,
+                                 bool(ctx.sampled))
+            else:
+                registry.observe(self._registry_key, value)
+
+
+class Timer(Instrument):
+    """
+    Durations are reported in microseconds like span durations
+    """
+
+    def record(self, seconds: float,
+               ctx: Optional['aioapp.tracer.Span'] = None) -> None:
+        """
+        :param ctx: span to keep as exemplar of the duration
+        """
+        trace_id = ctx.trace_id if ctx is not None else None
+        sampled = bool(ctx.sampled) if ctx is not None else False
+        metrics = self._bind()
+        if metrics is not None:
+            metrics.timer(self._key, int(seconds * 1000000), trace_id,
+                          sampled)
+        registry = self._bind_registry()
+        if registry is not None:
+            registry.observe(self._registry_key, seconds, trace_id, sampled)
+
+    def time(self, ctx: Optional['aioapp.tracer.Span'] = None) -> 'Timing':
+        """
+        with timer.time():
+            ...
+        """
+        return Timing(self, ctx)
+
+
+class Timing:
+
+    def __init__(self, timer: Timer,
+                 ctx: Optional['aioapp.tracer.Span'] = None) -> None:
+        self.timer = timer
+        self.ctx = ctx
+        self._start = 0.
+
+    def __enter__(self) -> 'Timing':
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.timer.record(time.perf_counter() - self._start, self.ctx)
+
+
+# (name, tags sorted by key)
+RegistryKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class HistogramStats:
+    __slots__ = ('counts', 'sum', 'count', 'exemplars')
+
+    def __init__(self, size: int) -> None:
+        self.counts = [0] * size
+        self.sum = 0.
+        self.count = 0
+        self.exemplars: Optional[Exemplars] = None
+
+
+class Registry:
+    """
+    Cumulative in-process metrics rendered in the Prometheus text format on
+    demand, so the serialization cost is paid per scrape instead of per
+    span. Span durations are kept as `<name>_duration_seconds` histograms.
+
+    Histogram buckets keep exemplar trace ids of the observed spans, they
+    are rendered only in the OpenMetrics format.
+
+    With `max_tag_values`, tags of span durations and instruments are
+    limited by a CardinalityLimiter like the ones of InfluxMetrics.
+    """
+
+    def __init__(self, prefix: str = '',
+                 buckets: Iterable[float] = DEFAULT_BUCKETS,
+                 max_tag_values: Optional[int] = None,
+                 tag_limits: Optional[Dict[str, int]] = None) -> None:
+        self.prefix = prefix
+        self.buckets = sorted(buckets)
+        self.limiter: Optional[CardinalityLimiter] = None
+        if max_tag_values is not None:
+            self.limiter = CardinalityLimiter(max_tag_values, tag_limits)
+        self.counters: Dict[RegistryKey, float] = {}
+        self.gauges: Dict[RegistryKey, float] = {}
+        self.histograms: Dict[RegistryKey, HistogramStats] = {}
+
+    @staticmethod
+    def key(name: str, tags: Optional[dict] = None) -> RegistryKey:
+        return name, tuple(sorted(tags.items())) if tags else ()
+
+    def series_key(self, name: str, tags: Optional[dict] = None
+                   ) -> RegistryKey:
+        """
+        Key with the tags limited by the cardinality limiter
+        """
+        if tags and self.limiter is not None:
+            tags = self.limiter.limit(name, tags)
+        return self.key(name, tags)
+
+    def count(self, key: RegistryKey, value: float = 1) -> None:
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, key: RegistryKey, value: float) -> None:
+        self.gauges[key] = value
+
+    def observe(self, key: RegistryKey, value: float,
+                trace_id: Optional[str] = None,
+                sampled: bool = False) -> None:
+        stats = self.histograms.get(key)
+        if stats is None:
+            stats = self.histograms[key] = HistogramStats(
+                len(self.buckets) + 1)
+        idx = bisect_left(self.buckets, value)
+        stats.counts[idx] += 1
+        stats.sum += value
+        stats.count += 1
+        if trace_id is not None:
+            if stats.exemplars is None:
+                stats.exemplars = Exemplars(len(self.buckets) + 1)
+            stats.exemplars.offer(idx, value, trace_id, sampled)
+
+    def observe_span(self, span: 'aioapp.tracer.Span') -> None:
+        tags = span._tags_metrics
+        if aioapp.tracer.SPAN_TYPE in tags:
+            tags = tags.copy()
+            name = tags.pop(aioapp.tracer.SPAN_TYPE)
+        else:
+            name = span._name
+        duration = (span._finish_stamp - span._start_stamp) / 1000000
+        self.observe(self.series_key('%s_duration_seconds' % name, tags),
+                     duration, span.trace_id, bool(span.sampled))
+
+    def _name(self, name: str) -> str:
+        return PROMETHEUS_NAME_RE.sub('_', self.prefix + name)
+
+    @staticmethod
+    def _labels(items: Iterable[Tuple[str, str]]) -> str:
+        labels = ','.join(
+            '%s="%s"' % (PROMETHEUS_NAME_RE.sub('_', key),
+                         str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in items)
+        return '{%s}' % labels if labels else ''
+
+    def render(self, openmetrics: bool = False) -> str:
+        """
+        Prometheus text format 0.0.4 or, with `openmetrics=True`,
+        OpenMetrics 1.0.0 with exemplars
+        """
+        lines: List[str] = []
+        self._render_simple(lines, self.counters, 'counter', '_total',
+                            openmetrics)
+        self._render_simple(lines, self.gauges, 'gauge', '', openmetrics)
+
+        typed = set()
+        for (name, items), stats in sorted(self.histograms.items(),
+                                           key=lambda item: item[0]):
+            name = self._name(name)
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s histogram' % name)
+            exemplars = (stats.exemplars.slots
+                         if openmetrics and stats.exemplars is not None
+                         else [None] * len(stats.counts))
+            cumulative = 0
+            for bound, count, exemplar in zip(self.buckets + [None],
+                                              stats.counts, exemplars):
+                cumulative += count
+                le = '+Inf' if bound is None else repr(float(bound))
+                line = '%s_bucket%s %s' % (
+                    name, self._labels(items + (('le', le),)), cumulative)
+                if exemplar is not None:
+                    line += ' # {trace_id="%s"} %s %.3f' % (
+                        exemplar.trace_id, repr(exemplar.value),
+                        exemplar.stamp)
+                lines.append(line)
+            labels = self._labels(items)
+            lines.append('%s_sum%s %s' % (name, labels, repr(stats.sum)))
+            lines.append('%s_count%s %s' % (name, labels, stats.count))
+        if openmetrics:
+            lines.append('# EOF')
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def _render_simple(self, lines: List[str],
+                       values: Dict[RegistryKey, float],
+                       type_name: str, suffix: str,
+                       openmetrics: bool) -> None:
+        typed = set()
+        for (name, items), value in sorted(values.items()):
+            name = self._name(name)
+            if suffix and not name.endswith(suffix):
+                name += suffix
+            if name not in typed:
+                typed.add(name)
+                # OpenMetrics names the family without the suffix
+                lines.append('# TYPE %s %s' % (
+                    name[:-len(suffix)] if openmetrics and suffix else name,
+                    type_name))
+            lines.append('%s%s %s' % (name, self._labels(items), value))
+
+
+class CardinalityLimiter:
+    """
+    Limits the number of distinct values of every tag per metric name.
+
+    Values seen after the limit is reached are replaced with OTHER. At most
+    `max_names` names are tracked, tags of names beyond that are always
+    replaced, so the limiter never holds more than
+    max_names * <tags per name> * <limit> values.
+    """
+
+    OTHER = '__other__'
+
+    def __init__(self, max_values: int = 100,
+                 limits: Optional[Dict[str, int]] = None,
+                 max_names: int = 1000,
+                 on_overflow: Optional[Callable[[str, str], Any]] = None
+                 ) -> None:
+        self.max_values = max_values
+        self.limits = limits or {}
+        self.max_names = max_names
+        self.on_overflow = on_overflow
+        self._seen: Dict[str, Dict[str, set]] = {}
+        self._overflow: Dict[str, set] = {}
+
+    def limit(self, name: str, tags: dict) -> dict:
+        seen = self._seen.get(name)
+        if seen is None:
+            if len(self._seen) >= self.max_names:
+                for key in tags:
+                    self._overflowed(name, key)
+                return {key: self.OTHER for key in tags}
+            seen = self._seen[name] = {}
+        limit = self.limits.get(name, self.max_values)
+        result = None
+        for key, value in tags.items():
+            values = seen.get(key)
+            if values is None:
+                values = seen[key] = set()
+            if value in values:
+                continue
+            if len(values) < limit:
+                values.add(value)
+                continue
+            if result is None:
+                result = dict(tags)
+            result[key] = self.OTHER
+            self._overflowed(name, key)
+        return tags if result is None else result
+
+    def _overflowed(self, name: str, key: str) -> None:
+        keys = self._overflow.get(name)
+        if keys is None:
+            keys = self._overflow[name] = set()
+        if key not in keys:
+            keys.add(key)
+            if self.on_overflow is not None:
+                self.on_overflow(name, key)
+
+    def overflow(self) -> Dict[str, List[str]]:
+        """
+        Names which hit their limits with the tags that did it
+        """
+        return {name: sorted(keys) for name, keys in self._overflow.items()}
@@ -1,21 +1,45 @@
+import os
 import inspect
 import string
+import threading
+import weakref
 from typing import Optional
 from random import SystemRandom
 import json
+import enum
+import uuid
 import datetime
 import decimal
+from math import isfinite
 from getpass import getuser
 from urllib.parse import urlparse, unquote
 import types
 from asyncio import ensure_future
 from functools import partial
 from urllib.parse import urlunsplit, urlsplit
+from collections import OrderedDict
 from yarl import URL
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+if not hasattr(orjson, 'OPT_PASSTHROUGH_DATETIME'):  # pragma: no cover
+    # older versions can not keep our datetime format
+    orjson = None
+
+# non str keys are left to raise, orjson formats float keys differently
+_ORJSON_OPTIONS = (
+    orjson.OPT_PASSTHROUGH_DATETIME |
+    getattr(orjson, 'OPT_PASSTHROUGH_DATACLASS', 0)
+    if orjson is not None else 0)
+
 
 def async_call(loop, func, *args, delay=None, **kwargs):
     """
+    Prefer `Application.scheduler`, it returns cancellable handles and
+    keeps many pending calls cheap.
 
     :type loop: asyncio.AbstractEventLoop
     :type func:
@@ -57,68 +81,291 @@ def mask_url_pwd(route: Optional[str]) -> Optional[str]:
     return urlunsplit(parsed)
 
 
+class _Binder:
+    """
+    Argument tables of a function compiled by `get_func_params`
+    """
+    __slots__ = ('names', 'name_set', 'defaults', 'varkw')
+
+    def __init__(self, method):
+        insp = inspect.getfullargspec(method)
+        args = insp.args
+        if isinstance(method, types.MethodType):
+            args = args[1:]  # skip self argument
+        defaults = {}
+        if insp.defaults:
+            defaults.update(zip(insp.args[-len(insp.defaults):],
+                                insp.defaults))
+        if insp.kwonlydefaults:
+            defaults.update(insp.kwonlydefaults)
+        self.names = tuple(args) + tuple(insp.kwonlyargs)
+        self.name_set = frozenset(self.names)
+        self.defaults = defaults
+        self.varkw = insp.varkw is not None
+
+    def bind(self, called_params):
+        params = {}
+        defaults = self.defaults
+        for name in self.names:
+            if name in called_params:
+                params[name] = called_params[name]
+            elif name in defaults:
+                params[name] = defaults[name]
+            else:
+                raise TypeError('Argument "%s" not given' % name)
+        name_set = self.name_set
+        if not name_set.issuperset(called_params):
+            unexpected = [name for name in called_params
+                          if name not in name_set]
+            if not self.varkw:
+                raise TypeError('Got unexpected parameter(s): %s'
+                                '' % (", ".join(unexpected)))
+            for name in unexpected:
+                params[name] = called_params[name]
+        return params
+
+
+_binders = weakref.WeakKeyDictionary()
+_method_binders = weakref.WeakKeyDictionary()
+
+
+def _get_binder(method):
+    if isinstance(method, types.MethodType):
+        cache, key = _method_binders, method.__func__
+    else:
+        cache, key = _binders, method
+    try:
+        binder = cache.get(key)
+    except TypeError:  # not hashable or weakrefable
+        return _Binder(method)
+    if binder is None:
+        binder = _Binder(method)
+        try:
+            cache[key] = binder
+        except TypeError:
+            pass
+    return binder
+
+
 def get_func_params(method, called_params):
     """
+    The argument tables are compiled once per function and cached while
+    the function is alive, bound methods share the tables of their
+    function.
+
     :type method: function
     :type called_params: dict
     :return:
     """
-    insp = inspect.getfullargspec(method)
+    binder = _get_binder(method)
     if not isinstance(called_params, dict):
         raise UserWarning()
-    _called_params = called_params.copy()
-    params = {}
-    arg_count = len(insp.args)
-    arg_def_count = len(insp.defaults) if insp.defaults is not None else 0
-    for i in range(arg_count):
-        arg = insp.args[i]
-        if i == 0 and isinstance(method, types.MethodType):
-            continue  # skip self argument
-        if arg in _called_params:
-            params[arg] = _called_params.pop(arg)
-        elif i - arg_count + arg_def_count >= 0:
-            params[arg] = insp.defaults[i - arg_count + arg_def_count]
-        else:
-            raise TypeError('Argument "%s" not given' % arg)
-    for kwarg in insp.kwonlyargs:
-        if kwarg in _called_params:
-            params[kwarg] = _called_params.pop(kwarg)
-        elif kwarg in insp.kwonlydefaults:
-            params[kwarg] = insp.kwonlydefaults[kwarg]
-        else:
-            raise TypeError('Argument "%s" not given' % kwarg)
-    if insp.varkw is None:
-        if len(_called_params) > 0:
-            raise TypeError('Got unexpected parameter(s): %s'
-                            '' % (", ".join(_called_params)))
-    else:
-        params.update(_called_params)
-    return params
+    return binder.bind(called_params)
 
 
-def _json_encoder(obj):
-    if isinstance(obj, URL):
+def _json_datetime(obj):
+    text = '%d-%02d-%02d %02d:%02d:%02d.%06d' % (
+        obj.year, obj.month, obj.day, obj.hour, obj.minute, obj.second,
+        obj.microsecond)
+    if obj.tzinfo is not None:
+        text += obj.strftime('%z')
+    return text
+
+
+def _json_date(obj):
+    return '%d-%02d-%02d' % (obj.year, obj.month, obj.day)
+
+
+def _json_time(obj):
+    text = '%02d:%02d:%02d.%06d' % (obj.hour, obj.minute, obj.second,
+                                    obj.microsecond)
+    if obj.tzinfo is not None:
+        text += obj.strftime('%z')
+    return text
+
+
+def _json_bytes(obj):
+    try:
+        return obj.decode('UTF8')
+    except Exception:
         return str(obj)
-    if isinstance(obj, decimal.Decimal):
-        return float(obj)
-    if isinstance(obj, datetime.datetime):
-        return obj.strftime('%Y-%m-%d %H:%M:%S.%f%z')
-    if isinstance(obj, datetime.date):
-        return obj.strftime('%Y-%m-%d')
-    if isinstance(obj, datetime.time):
-        return obj.strftime('%H:%M:%S.%f%z')
-    if isinstance(obj, datetime.timedelta):
-        return obj.total_seconds()
-    if isinstance(obj, bytes):
-        try:
-            return obj.decode('UTF8')
-        except Exception:
-            return str(obj)
+
+
+# checked in this order for subclasses, datetime is a subclass of date
+_JSON_ENCODERS = OrderedDict((
+    (URL, str),
+    (decimal.Decimal, float),
+    (datetime.datetime, _json_datetime),
+    (datetime.date, _json_date),
+    (datetime.time, _json_time),
+    (datetime.timedelta, datetime.timedelta.total_seconds),
+    (bytes, _json_bytes),
+))
+
+
+def _json_encoder(obj):
+    encoder = _JSON_ENCODERS.get(type(obj))
+    if encoder is not None:
+        return encoder(obj)
+    for cls, encoder in _JSON_ENCODERS.items():
+        if isinstance(obj, cls):
+            return encoder(obj)
     return repr(obj)
 
 
+_json_str_encoder = json.JSONEncoder(default=_json_encoder)
+_json_bytes_encoder = json.JSONEncoder(default=_json_encoder,
+                                       separators=(',', ':'),
+                                       ensure_ascii=False)
+
+
 def json_encode(data):
-    return json.dumps(data, default=_json_encoder)
+    return _json_str_encoder.encode(data)
+
+
+def _stdlib_dumps_bytes(data):
+    return _json_bytes_encoder.encode(data).encode()
+
+
+# encoded alike by both backends, orjson hands the ones which are not JSON
+# types to _json_encoder
+_ORJSON_PLAIN_TYPES = frozenset((
+    str, int, bool, type(None), URL, bytes, datetime.datetime,
+    datetime.date, datetime.time, datetime.timedelta))
+
+
+def _orjson_compatible(data):
+    """
+    Whether orjson encodes `data` to the same values as the stdlib encoder.
+    It writes NaN and infinity as null, UUIDs as plain strings and Enum
+    members as their values
+    """
+    stack = [data]
+    pop = stack.pop
+    extend = stack.extend
+    plain = _ORJSON_PLAIN_TYPES
+    while stack:
+        obj = pop()
+        cls = type(obj)
+        if cls in plain:
+            continue
+        if cls is dict:
+            extend(obj.values())
+        elif cls is list or cls is tuple:
+            extend(obj)
+        elif cls is float:
+            if not isfinite(obj):
+                return False
+        elif cls is decimal.Decimal:
+            # encoded as float
+            if not obj.is_finite():
+                return False
+        elif isinstance(obj, (str, int)):
+            # including the Enum members the stdlib encodes as values
+            pass
+        elif isinstance(obj, (enum.Enum, uuid.UUID)):
+            return False
+        elif isinstance(obj, dict):
+            extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            extend(obj)
+        elif isinstance(obj, float):
+            if not isfinite(obj):
+                return False
+        elif isinstance(obj, decimal.Decimal):
+            if not obj.is_finite():
+                return False
+    return True
+
+
+def _orjson_default(obj):
+    if isinstance(obj, tuple):
+        # named tuples are arrays for the stdlib encoder
+        return list(obj)
+    return _json_encoder(obj)
+
+
+def _orjson_dumps_bytes(data):
+    if not _orjson_compatible(data):
+        return _stdlib_dumps_bytes(data)
+    try:
+        return orjson.dumps(data, default=_orjson_default,
+                            option=_ORJSON_OPTIONS)
+    except orjson.JSONEncodeError:
+        # e.g. integers over 64 bits or keys which are not strings
+        return _stdlib_dumps_bytes(data)
+
+
+JSON_BACKENDS = ('orjson', 'stdlib')
+_json_backend = 'stdlib'
+_json_dumps_bytes = _stdlib_dumps_bytes
+
+
+def set_json_backend(name=None):
+    """
+    Selects the encoder of `json_encode_bytes` and `json_encode_stream`:
+    'stdlib', the default, or 'orjson' if it is installed.
+
+    Both give the values `json_encode` gives, orjson only formats float
+    exponents differently. Data orjson would encode differently, like NaN,
+    UUIDs, Enum members or keys which are not strings, is encoded by the
+    stdlib backend, so orjson pays off for large documents of plain types.
+
+    :type name: str
+    :return: name of the backend
+    """
+    global _json_backend, _json_dumps_bytes
+    if name is None:
+        name = 'stdlib'
+    if name == 'orjson' and orjson is not None:
+        _json_dumps_bytes = _orjson_dumps_bytes
+    elif name == 'stdlib':
+        _json_dumps_bytes = _stdlib_dumps_bytes
+    else:
+        raise UserWarning('JSON backend %s is not available' % name)
+    _json_backend = name
+    return name
+
+
+def get_json_backend():
+    return _json_backend
+
+
+def json_encode_bytes(data):
+    """
+    Compact UTF-8 JSON
+    """
+    return _json_dumps_bytes(data)
+
+
+def json_encode_stream(items, chunk_size=65536):
+    """
+    Encodes an iterable as JSON array item by item, yielding chunks of
+    about `chunk_size` bytes, so the whole document is never built
+
+    :type items: collections.Iterable
+    :type chunk_size: int
+    :rtype: collections.Iterator[bytes]
+    """
+    dumps = _json_dumps_bytes
+    chunk = [b'[']
+    size = 1
+    sep = b''
+    for item in items:
+        data = dumps(item)
+        chunk.append(sep)
+        chunk.append(data)
+        sep = b','
+        size += len(data) + 1
+        if size >= chunk_size:
+            yield b''.join(chunk)
+            chunk = []
+            size = 0
+    chunk.append(b']')
+    yield b''.join(chunk)
+
+
+set_json_backend()
 
 
 def parse_dsn(dsn, default_port=5432, protocol='http://'):
@@ -146,6 +393,93 @@ def parse_dsn(dsn, default_port=5432, protocol='http://'):
     ]
 
 
+class TokenGenerator:
+    """
+    Random strings over an alphabet of up to 256 characters made from
+    os.urandom read in blocks of `block_size` bytes.
+
+    Random bytes are mapped to the alphabet by rejection sampling: bytes
+    outside the largest multiple of the alphabet size are dropped, so every
+    character is equally likely. Buffered bytes are dropped in a forked
+    child, so it never repeats tokens of its parent. Safe to use from
+    several threads.
+    """
+
+    def __init__(self, chars=string.ascii_uppercase + string.digits,
+                 block_size=4096):
+        if not 0 < len(chars) <= 256:
+            raise UserWarning('Alphabet must have from 1 to 256 characters')
+        self.chars = chars
+        self.block_size = block_size
+        limit = 256 - 256 % len(chars)
+        self._rejected = bytes(range(limit, 256))
+        self._table = None
+        if all(ord(char) < 128 for char in chars):
+            self._table = bytes(ord(chars[byte % len(chars)])
+                                for byte in range(256))
+        self._buf = ''
+        self._pos = 0
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def _fill(self, size):
+        # at least `size` new characters, keeping the unused ones
+        chunks = [self._buf[self._pos:]]
+        have = len(chunks[0])
+        while have < size:
+            block = os.urandom(max(self.block_size, size - have))
+            if self._table is not None:
+                chunk = block.translate(self._table,
+                                        self._rejected).decode('ascii')
+            else:
+                limit = 256 - len(self._rejected)
+                chunk = ''.join(self.chars[byte % len(self.chars)]
+                                for byte in block if byte < limit)
+            chunks.append(chunk)
+            have += len(chunk)
+        self._buf = ''.join(chunks)
+        self._pos = 0
+
+    def token(self, size=6):
+        return self.tokens(1, size)[0]
+
+    def tokens(self, count, size=6):
+        """
+        :type count: int
+        :type size: int
+        :rtype: list
+        """
+        if size < 0 or count < 0:
+            raise UserWarning('Token size and count must not be negative')
+        if size == 0:
+            return [''] * count
+        with self._lock:
+            pid = os.getpid()
+            if pid != self._pid:
+                self._pid = pid
+                self._buf = ''
+                self._pos = 0
+            total = count * size
+            if len(self._buf) - self._pos < total:
+                self._fill(total)
+            pos = self._pos
+            self._pos = pos + total
+            buf = self._buf
+        return [buf[i:i + size] for i in range(pos, pos + total, size)]
+
+
+_token_generators = {}
+
+
 def rndstr(size=6, chars=string.ascii_uppercase + string.digits):
-    cryptogen = SystemRandom()
-    return ''.join(cryptogen.choice(chars) for _ in range(size))
+    gen = _token_generators.get(chars)
+    if gen is None:
+        if len(chars) > 256:
+            if size < 0:
+                raise UserWarning('Token size must not be negative')
+            cryptogen = SystemRandom()
+            return ''.join(cryptogen.choice(chars) for _ in range(size))
+        gen = TokenGenerator(chars)
+        if len(_token_generators) < 64:
+            _token_generators[chars] = gen
+    return gen.token(size)
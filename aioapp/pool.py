@@ -0,0 +1,317 @@
+import asyncio
+from collections import deque
+from typing import Optional, Any, Deque, Tuple, Set
+from .app import Component
+from .error import PrepareError, PoolClosedError, PoolTimeoutError
+from .scheduler import TimerHandle
+from .tracer import Span, CLIENT
+
+
+class PoolComponent(Component):
+    """
+    Base of components keeping a pool of connections.
+
+    Subclasses implement `create_conn` and `close_conn`, and may implement
+    `check_conn` used by the health check. `min_size` connections are
+    opened in `prepare` and kept open, up to `max_size` are opened on
+    demand. Connections idle for more than `max_idle_time` seconds are
+    closed down to `min_size`. Waiting for or opening a connection longer
+    than `acquire_timeout` raises PoolTimeoutError.
+
+    Every acquire is a `<name>_acquire` child span of the caller's span.
+    Pool size, connections in use, idle connections, waiting acquires and
+    utilization (in use / max size) are reported as `pool_*` gauges tagged
+    with the pool name every `stats_interval` seconds, idle connections are
+    checked at the same time.
+
+        async with pool.acquire(ctx) as conn:
+            ...
+    """
+
+    def __init__(self, name: str, min_size: int = 1, max_size: int = 10,
+                 acquire_timeout: Optional[float] = 5.,
+                 max_idle_time: Optional[float] = 300.,
+                 stats_interval: float = 1.) -> None:
+        super(PoolComponent, self).__init__()
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise UserWarning('Invalid pool size')
+        self.name = name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.max_idle_time = max_idle_time
+        self.stats_interval = stats_interval
+        # connections opened or being opened
+        self._size = 0
+        self._idle: Deque[Tuple[Any, float]] = deque()
+        self._in_use: Set[Any] = set()
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._closing = False
+        self._maintain_handle: Optional[TimerHandle] = None
+        self._gauges: dict = {}
+
+    async def create_conn(self, ctx: Span) -> Any:
+        raise NotImplementedError()
+
+    async def close_conn(self, conn: Any) -> None:
+        raise NotImplementedError()
+
+    async def check_conn(self, ctx: Span, conn: Any) -> None:
+        """
+        Raises exception if the connection is broken
+        :raises: Exception
+        """
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def in_use(self) -> int:
+        return len(self._in_use)
+
+    @property
+    def idle(self) -> int:
+        return len(self._idle)
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def prepare(self) -> None:
+        if self.app is None:
+            raise PrepareError('Component is not added to an application')
+        self._closing = False
+        with self.app.tracer.new_trace() as ctx:
+            ctx.name('%s_warmup' % self.name)
+            self._size += self.min_size
+            results = await asyncio.gather(
+                *[self._create(ctx) for _ in range(self.min_size)],
+                loop=self.loop, return_exceptions=True)
+            errors = [res for res in results if isinstance(res, Exception)]
+            conns = [res for res in results
+                     if not isinstance(res, Exception)]
+            if errors:
+                self._size -= len(conns)
+                await asyncio.gather(*[self._close(conn) for conn in conns],
+                                     loop=self.loop)
+                raise PrepareError('Could not open %s connections: %s'
+                                   '' % (self.name, errors[0]))
+            now = self.loop.time()
+            self._idle.extend((conn, now) for conn in conns)
+
+    async def start(self) -> None:
+        self._maintain_handle = self.app.scheduler.call_later(
+            self.stats_interval, self._maintain)
+
+    async def stop(self) -> None:
+        self._closing = True
+        if self._maintain_handle is not None:
+            self._maintain_handle.cancel()
+            self._maintain_handle = None
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_exception(PoolClosedError())
+        idle = [conn for conn, _ in self._idle]
+        self._idle.clear()
+        self._size -= len(idle)
+        await asyncio.gather(*[self.close_conn(conn) for conn in idle],
+                             loop=self.loop, return_exceptions=True)
+        self._report()
+
+    async def health(self, ctx: Span) -> None:
+        conn = await self.acquire_conn(ctx)
+        try:
+            await self.check_conn(ctx, conn)
+        except BaseException:
+            self.release(conn, discard=True)
+            raise
+        self.release(conn)
+
+    def should_discard(self, err: Optional[BaseException]) -> bool:
+        """
+        Whether a connection released after `err` was raised in the
+        `acquire` block is to be closed
+        """
+        return isinstance(err, (OSError, asyncio.TimeoutError,
+                                asyncio.CancelledError))
+
+    def acquire(self, ctx: Span) -> 'PoolAcquireContext':
+        return PoolAcquireContext(self, ctx)
+
+    async def acquire_conn(self, ctx: Span) -> Any:
+        """
+        Connection which must be given back with `release`
+        """
+        span = ctx.new_child('%s_acquire' % self.name, CLIENT)
+        with span:
+            if self._closing:
+                raise PoolClosedError()
+            if self._idle:
+                conn, _ = self._idle.pop()
+                self._in_use.add(conn)
+                return conn
+            if self._size < self.max_size:
+                self._size += 1
+                try:
+                    # the size is given back by _create on failure
+                    conn = await asyncio.wait_for(
+                        self._create(span), self.acquire_timeout,
+                        loop=self.loop)
+                except asyncio.TimeoutError:
+                    raise PoolTimeoutError(
+                        'Could not open a %s connection in %s seconds'
+                        '' % (self.name, self.acquire_timeout))
+                if self._closing:
+                    self._size -= 1
+                    await self._close(conn)
+                    raise PoolClosedError()
+                self._in_use.add(conn)
+                return conn
+            span.annotate('wait')
+            waiter = self.loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                conn = await asyncio.wait_for(waiter, self.acquire_timeout,
+                                              loop=self.loop)
+            except BaseException as err:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                if not waiter.done() or waiter.cancelled() or \
+                        waiter.exception() is not None:
+                    if isinstance(err, asyncio.TimeoutError):
+                        raise PoolTimeoutError(
+                            'No %s connection available in %s seconds'
+                            '' % (self.name, self.acquire_timeout))
+                    raise
+                # handed over just before the timeout or cancellation
+                conn = waiter.result()
+                if not isinstance(err, asyncio.TimeoutError):
+                    self._put(conn)
+                    raise
+            self._in_use.add(conn)
+            return conn
+
+    def release(self, conn: Any, discard: bool = False) -> None:
+        """
+        :param discard: close the connection instead of reusing it, e.g.
+                        after a connection error
+        """
+        if conn not in self._in_use:
+            # released twice
+            return
+        self._in_use.remove(conn)
+        if discard or self._closing:
+            self._size -= 1
+            asyncio.ensure_future(self._close(conn), loop=self.loop)
+            if self._waiters and not self._closing:
+                # open a replacement for the first waiter
+                self._grow()
+            return
+        self._put(conn)
+
+    def _put(self, conn: Any) -> None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(conn)
+                return
+        self._idle.append((conn, self.loop.time()))
+
+    def _grow(self) -> None:
+        self._size += 1
+        asyncio.ensure_future(self._open(), loop=self.loop)
+
+    async def _create(self, ctx: Span) -> Any:
+        """
+        Counted in size before the call
+        """
+        try:
+            with ctx.new_child('%s_connect' % self.name, CLIENT) as span:
+                return await self.create_conn(span)
+        except BaseException:
+            self._size -= 1
+            raise
+
+    async def _open(self) -> None:
+        """
+        Opens a connection in background for a waiter or for the idle ones
+        """
+        try:
+            if self.app is None:
+                self._size -= 1
+                raise PrepareError('Component is not added to an application')
+            with self.app.tracer.new_trace() as ctx:
+                ctx.name('%s_grow' % self.name)
+                conn = await self._create(ctx)
+        except Exception as err:
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                if not waiter.done():
+                    waiter.set_exception(err)
+            return
+        if self._closing:
+            self._size -= 1
+            await self._close(conn)
+        else:
+            self._put(conn)
+
+    async def _close(self, conn: Any) -> None:
+        """
+        Removed from size before the call
+        """
+        try:
+            await self.close_conn(conn)
+        except Exception as err:
+            self.app.log_err(err)
+
+    def _maintain(self) -> None:
+        if self._closing:
+            return
+        if self.max_idle_time is not None:
+            deadline = self.loop.time() - self.max_idle_time
+            # the oldest connections are on the left, reused ones on the
+            # right
+            while (self._idle and self._idle[0][1] < deadline
+                   and self._size > self.min_size):
+                conn, _ = self._idle.popleft()
+                self._size -= 1
+                asyncio.ensure_future(self._close(conn), loop=self.loop)
+        while self._size < self.min_size:
+            self._grow()
+        self._report()
+        self._maintain_handle = self.app.scheduler.call_later(
+            self.stats_interval, self._maintain)
+
+    def _report(self) -> None:
+        if self.app is None:
+            return
+        tracer = self.app.tracer
+        for name, value in (
+                ('pool_size', self._size),
+                ('pool_in_use', len(self._in_use)),
+                ('pool_idle', len(self._idle)),
+                ('pool_waiting', len(self._waiters)),
+                ('pool_utilization', len(self._in_use) / self.max_size)):
+            gauge = self._gauges.get(name)
+            if gauge is None:
+                gauge = self._gauges[name] = tracer.gauge(
+                    name, {'pool': self.name})
+            gauge.set(value)
+
+
+class PoolAcquireContext:
+
+    def __init__(self, pool: PoolComponent, ctx: Span) -> None:
+        self.pool = pool
+        self.ctx = ctx
+        self.conn: Any = None
+
+    async def __aenter__(self) -> Any:
+        self.conn = await self.pool.acquire_conn(self.ctx)
+        return self.conn
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        conn, self.conn = self.conn, None
+        self.pool.release(conn, discard=self.pool.should_discard(exc))
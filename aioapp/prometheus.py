@@ -0,0 +1,107 @@
+import asyncio
+from typing import Optional
+from .app import Component
+from .error import PrepareError
+from .tracer import Span
+
+
+class PrometheusExporter(Component):
+    """
+    Serves the tracer registry in the Prometheus text format.
+
+    Enables the registry of the application tracer on prepare, so span
+    durations and instrument values are aggregated in process, and renders
+    it only when scraped. The listener is a minimal HTTP/1.0 server
+    answering GET requests to `path` and closing the connection, it listens
+    on the loopback interface unless another `host` is given. Scrapers
+    accepting OpenMetrics get that format, with exemplar trace ids.
+
+    With `max_tag_values`, every tag of a metric name takes at most that
+    many distinct values in the registry, the following ones are reported
+    as `__other__`.
+    """
+
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    openmetrics_content_type = ('application/openmetrics-text; '
+                                'version=1.0.0; charset=utf-8')
+    max_request_size = 8192
+    read_timeout = 10.
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 9100,
+                 path: str = '/metrics', prefix: str = '',
+                 max_tag_values: Optional[int] = None) -> None:
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.path = path
+        self.prefix = prefix
+        self.max_tag_values = max_tag_values
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def prepare(self) -> None:
+        if self.app is None:
+            raise PrepareError('Component is not added to an application')
+        if self.app.tracer.registry is None:
+            self.app.tracer.setup_registry(
+                prefix=self.prefix, max_tag_values=self.max_tag_values)
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self._handle, self.host,
+                                                 self.port, loop=self.loop)
+
+    async def stop(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def health(self, ctx: Span) -> None:
+        if self.server is None:
+            raise Exception('Metrics listener is not running')
+
+    async def _handle(self, reader: asyncio.StreamReader,
+                      writer: asyncio.StreamWriter) -> None:
+        try:
+            head = await asyncio.wait_for(self._read_head(reader),
+                                          self.read_timeout, loop=self.loop)
+            method, path = head[0].split(' ')[:2] if head else ('', '')
+            openmetrics = any(
+                line.lower().startswith('accept:')
+                and 'application/openmetrics-text' in line
+                for line in head[1:])
+            content_type = (self.openmetrics_content_type if openmetrics
+                            else self.content_type)
+            if method != 'GET':
+                status, body = '405 Method Not Allowed', ''
+            elif path.split('?')[0] != self.path:
+                status, body = '404 Not Found', ''
+            else:
+                registry = self.app.tracer.registry if self.app else None
+                status = '200 OK'
+                body = (registry.render(openmetrics)
+                        if registry is not None else '')
+            data = body.encode()
+            writer.write(('HTTP/1.0 %s\r\n'
+                          'Content-Type: %s\r\n'
+                          'Content-Length: %s\r\n'
+                          'Connection: close\r\n\r\n'
+                          '' % (status, content_type, len(data))
+                          ).encode() + data)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_head(self, reader: asyncio.StreamReader) -> list:
+        lines = []
+        size = 0
+        while True:
+            line = await reader.readline()
+            size += len(line)
+            if size > self.max_request_size:
+                raise ValueError('Request is too large')
+            line = line.rstrip(b'\r\n')
+            if not line:
+                return lines
+            lines.append(line.decode('latin-1'))
@@ -0,0 +1,523 @@
+import random
+import asyncio
+from collections import deque
+from typing import Optional, Callable, Any, Deque, Dict, Tuple, Type
+from .app import Component
+from .error import BulkheadFullError, BulkheadTimeoutError, CircuitOpenError
+from .metrics import Counter, Gauge
+from .tracer import Tracer, Span
+
+CLOSED = 'closed'
+HALF_OPEN = 'half_open'
+OPEN = 'open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class Bulkhead:
+    """
+    Limits concurrent operations on a named resource.
+
+    Up to `max_concurrent` operations run at once, the next ones wait in a
+    FIFO queue of at most `max_queued` entries. An operation is rejected
+    with BulkheadFullError if the queue is full and with
+    BulkheadTimeoutError if it waits longer than `queue_timeout` seconds.
+
+    Waiting in the queue is a `<name>_queue` child span of the caller's
+    span. Operations in flight and in the queue are reported as
+    `bulkhead_in_flight` and `bulkhead_queued` gauges tagged with the
+    bulkhead name at most every `stats_interval` seconds and whenever the
+    bulkhead becomes idle, rejections are counted by `bulkhead_rejected`.
+
+        async with bulkhead.acquire(ctx):
+            ...
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 tracer: Optional[Tracer] = None,
+                 name: str = 'bulkhead', max_concurrent: int = 10,
+                 max_queued: int = 100,
+                 queue_timeout: Optional[float] = 5.,
+                 stats_interval: float = 1.) -> None:
+        if max_concurrent < 1 or max_queued < 0:
+            raise UserWarning('Invalid bulkhead limits')
+        self.loop = loop
+        self.tracer = tracer
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.stats_interval = stats_interval
+        self._in_flight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._gauges: Dict[str, Gauge] = {}
+        self._counters: Dict[str, Counter] = {}
+        self._stats_stamp = 0.
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def acquire(self, ctx: Span) -> 'BulkheadContext':
+        return BulkheadContext(self, ctx)
+
+    async def call(self, ctx: Span, func: Callable, *args: Any,
+                   **kwargs: Any) -> Any:
+        """
+        Awaits `func(*args, **kwargs)` in the bulkhead
+        """
+        await self.enter(ctx)
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            self.release()
+
+    async def enter(self, ctx: Span) -> None:
+        """
+        Takes a slot which must be given back with `release`
+        """
+        if self._in_flight < self.max_concurrent and not self._waiters:
+            self._in_flight += 1
+            self._changed()
+            return
+        if len(self._waiters) >= self.max_queued:
+            self._reject('full')
+            raise BulkheadFullError('%s bulkhead queue is full' % self.name)
+        with ctx.new_child('%s_queue' % self.name) as span:
+            span.tag('bulkhead.queued', len(self._waiters))
+            waiter = self.loop.create_future()
+            self._waiters.append(waiter)
+            self._changed()
+            try:
+                await asyncio.wait_for(waiter, self.queue_timeout,
+                                       loop=self.loop)
+            except BaseException as err:
+                if not waiter.done() or waiter.cancelled():
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+                    self._changed()
+                    if isinstance(err, asyncio.TimeoutError):
+                        self._reject('timeout')
+                        raise BulkheadTimeoutError(
+                            'No %s bulkhead slot in %s seconds'
+                            '' % (self.name, self.queue_timeout))
+                    raise
+                # handed over just before the timeout or cancellation
+                if not isinstance(err, asyncio.TimeoutError):
+                    self.release()
+                    raise
+
+    def release(self) -> None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # the slot goes to the first waiter
+                waiter.set_result(None)
+                self._changed()
+                return
+        self._in_flight -= 1
+        self._changed()
+
+    def _changed(self) -> None:
+        if self.tracer is None:
+            return
+        if ((not self._in_flight and not self._waiters) or
+                self.loop.time() - self._stats_stamp >= self.stats_interval):
+            self._report()
+
+    def _report(self) -> None:
+        self._stats_stamp = self.loop.time()
+        for name, value in (('bulkhead_in_flight', self._in_flight),
+                            ('bulkhead_queued', len(self._waiters))):
+            gauge = self._gauges.get(name)
+            if gauge is None:
+                gauge = self._gauges[name] = self.tracer.gauge(
+                    name, {'bulkhead': self.name})
+            gauge.set(value)
+
+    def _reject(self, reason: str) -> None:
+        if self.tracer is None:
+            return
+        counter = self._counters.get(reason)
+        if counter is None:
+            counter = self._counters[reason] = self.tracer.counter(
+                'bulkhead_rejected', {'bulkhead': self.name,
+                                      'reason': reason})
+        counter.inc()
+
+
+class BulkheadContext:
+
+    def __init__(self, bulkhead: Bulkhead, ctx: Span) -> None:
+        self.bulkhead = bulkhead
+        self.ctx = ctx
+
+    async def __aenter__(self) -> None:
+        await self.bulkhead.enter(self.ctx)
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self.bulkhead.release()
+
+
+class CircuitBreaker(Component):
+    """
+    Stops calling a failing downstream for a while.
+
+    Outcomes of the calls are counted over a sliding window of `window`
+    seconds split into `buckets` buckets. Once the window holds at least
+    `min_calls` calls, the circuit opens if the ratio of failed calls
+    reaches `failure_ratio`, or the ratio of calls lasting
+    `slow_call_duration` seconds or more reaches `slow_call_ratio`. Calls
+    on an open circuit raise CircuitOpenError without being made.
+
+    After `open_timeout` seconds the circuit is half-open and lets
+    `half_open_calls` probe calls through: it closes when all of them
+    succeed in time and opens again as soon as one does not.
+
+    State changes are annotated on the span of the call causing them and
+    reported as the `circuit_breaker_state` gauge (0 closed, 1 half-open,
+    2 open) tagged with the breaker name, through `tracer` or the tracer of
+    the application. The breaker works on its own, it is a component only
+    for the health check: added to the application with `Application.add`,
+    it shows as unhealthy in `Application.health` while the circuit is not
+    closed.
+
+        async with breaker.guard(ctx):
+            ...
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 tracer: Optional[Tracer] = None,
+                 name: str = 'circuit_breaker',
+                 window: float = 10., buckets: int = 10,
+                 min_calls: int = 20, failure_ratio: float = 0.5,
+                 slow_call_duration: Optional[float] = None,
+                 slow_call_ratio: float = 0.5,
+                 open_timeout: float = 30.,
+                 half_open_calls: int = 1) -> None:
+        super(CircuitBreaker, self).__init__()
+        if buckets < 1 or min_calls < 1 or half_open_calls < 1:
+            raise UserWarning('Invalid circuit breaker settings')
+        self.loop = loop
+        self.tracer = tracer
+        self.name = name
+        self.window = window
+        self.buckets = buckets
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.slow_call_duration = slow_call_duration
+        self.slow_call_ratio = slow_call_ratio
+        self.open_timeout = open_timeout
+        self.half_open_calls = half_open_calls
+        self._bucket_width = window / buckets
+        # [bucket index, calls, failures, slow calls]
+        self._window: Deque[list] = deque()
+        self._calls = 0
+        self._failures = 0
+        self._slow = 0
+        self._state = CLOSED
+        # outcomes of calls started before a state change are ignored
+        self._generation = 0
+        self._opened_at = 0.
+        self._probes = 0
+        self._successes = 0
+        self._gauge: Optional[Gauge] = None
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    async def prepare(self) -> None:
+        pass
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    async def health(self, ctx: Span) -> None:
+        state = self._state
+        if (state == OPEN and
+                self.loop.time() >= self._opened_at + self.open_timeout):
+            # the next call is let through as a probe
+            state = HALF_OPEN
+        if state != CLOSED:
+            raise CircuitOpenError('%s circuit is %s' % (self.name, state))
+
+    def is_failure(self, err: BaseException) -> bool:
+        """
+        Whether an exception raised by a call counts as a failure
+        """
+        return (isinstance(err, Exception) and
+                not isinstance(err, asyncio.CancelledError))
+
+    def guard(self, ctx: Span) -> 'CircuitBreakerContext':
+        return CircuitBreakerContext(self, ctx)
+
+    async def call(self, ctx: Span, func: Callable, *args: Any,
+                   **kwargs: Any) -> Any:
+        """
+        Awaits `func(*args, **kwargs)` unless the circuit is open
+        """
+        async with self.guard(ctx):
+            return await func(*args, **kwargs)
+
+    def _enter(self, ctx: Span) -> int:
+        if self._state == OPEN:
+            if self.loop.time() < self._opened_at + self.open_timeout:
+                raise CircuitOpenError('%s circuit is open' % self.name)
+            self._transition(ctx, HALF_OPEN)
+        if self._state == HALF_OPEN:
+            if self._probes + self._successes >= self.half_open_calls:
+                raise CircuitOpenError('%s circuit is half-open'
+                                       '' % self.name)
+            self._probes += 1
+        return self._generation
+
+    def _exit(self, ctx: Span, generation: int, duration: float,
+              err: Optional[BaseException]) -> None:
+        if generation != self._generation:
+            return
+        cancelled = isinstance(err, asyncio.CancelledError)
+        failed = err is not None and self.is_failure(err)
+        slow = (self.slow_call_duration is not None and
+                duration >= self.slow_call_duration)
+        if self._state == HALF_OPEN:
+            self._probes -= 1
+            if failed or slow:
+                self._transition(ctx, OPEN)
+            elif not cancelled:
+                self._successes += 1
+                if self._successes >= self.half_open_calls:
+                    self._transition(ctx, CLOSED)
+            return
+        if cancelled:
+            return
+        self._record(failed, slow)
+        calls = self._calls
+        if calls >= self.min_calls and (
+                self._failures >= self.failure_ratio * calls or
+                (self.slow_call_duration is not None and
+                 self._slow >= self.slow_call_ratio * calls)):
+            self._transition(ctx, OPEN)
+
+    def _record(self, failed: bool, slow: bool) -> None:
+        idx = int(self.loop.time() / self._bucket_width)
+        window = self._window
+        while window and window[0][0] <= idx - self.buckets:
+            _, calls, failures, slow_calls = window.popleft()
+            self._calls -= calls
+            self._failures -= failures
+            self._slow -= slow_calls
+        if not window or window[-1][0] != idx:
+            window.append([idx, 0, 0, 0])
+        bucket = window[-1]
+        bucket[1] += 1
+        bucket[2] += failed
+        bucket[3] += slow
+        self._calls += 1
+        self._failures += failed
+        self._slow += slow
+
+    def _transition(self, ctx: Span, state: str) -> None:
+        self._state = state
+        self._generation += 1
+        self._probes = 0
+        self._successes = 0
+        if state == OPEN:
+            self._opened_at = self.loop.time()
+        elif state == CLOSED:
+            self._window.clear()
+            self._calls = self._failures = self._slow = 0
+        ctx.annotate('%s circuit %s' % (self.name, state))
+        tracer = self.tracer
+        if tracer is None and self.app is not None:
+            tracer = self.app.tracer
+        if tracer is not None:
+            if self._gauge is None:
+                self._gauge = tracer.gauge('circuit_breaker_state',
+                                           {'breaker': self.name})
+            self._gauge.set(STATE_VALUES[state])
+
+
+class CircuitBreakerContext:
+
+    def __init__(self, breaker: CircuitBreaker, ctx: Span) -> None:
+        self.breaker = breaker
+        self.ctx = ctx
+        self.generation = 0
+        self.started = 0.
+
+    async def __aenter__(self) -> None:
+        self.generation = self.breaker._enter(self.ctx)
+        self.started = self.breaker.loop.time()
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self.breaker._exit(self.ctx, self.generation,
+                           self.breaker.loop.time() - self.started, exc)
+
+
+class RetryBudget:
+    """
+    Caps the retries to a service to a fraction of its calls.
+
+    A retry is allowed while the retries of the last `window` seconds stay
+    below `ratio` of the calls of the same period plus `min_retries`, which
+    lets services with little traffic retry. Share one budget between all
+    the Retry policies calling the same service.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, ratio: float = 0.1,
+                 min_retries: int = 10, window: float = 10.,
+                 buckets: int = 10) -> None:
+        if buckets < 1 or ratio < 0 or min_retries < 0:
+            raise UserWarning('Invalid retry budget settings')
+        self.loop = loop
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self.buckets = buckets
+        self._bucket_width = window / buckets
+        # [bucket index, calls, retries]
+        self._window: Deque[list] = deque()
+        self._calls = 0
+        self._retries = 0
+
+    @property
+    def calls(self) -> int:
+        self._bucket()
+        return self._calls
+
+    @property
+    def retries(self) -> int:
+        self._bucket()
+        return self._retries
+
+    def record_call(self) -> None:
+        self._bucket()[1] += 1
+        self._calls += 1
+
+    def try_retry(self) -> bool:
+        """
+        Whether a retry is allowed, it is recorded if so
+        """
+        bucket = self._bucket()
+        if self._retries >= self.min_retries + self.ratio * self._calls:
+            return False
+        bucket[2] += 1
+        self._retries += 1
+        return True
+
+    def _bucket(self) -> list:
+        idx = int(self.loop.time() / self._bucket_width)
+        window = self._window
+        while window and window[0][0] <= idx - self.buckets:
+            _, calls, retries = window.popleft()
+            self._calls -= calls
+            self._retries -= retries
+        if not window or window[-1][0] != idx:
+            window.append([idx, 0, 0])
+        return window[-1]
+
+
+class Retry:
+    """
+    Retries failed calls with exponential backoff and jitter.
+
+    A call is made up to `attempts` times. The delay before retry N is
+    `base_delay * multiplier ** (N - 1)` capped at `max_delay`, reduced by
+    up to `jitter` of itself at random so that clients don't retry in
+    step (1 is full jitter, 0 none). Only errors for which `should_retry`
+    is true are retried, by default the ones of `retry_on`.
+
+    With a `budget`, calls giving up on a retry the budget doesn't allow
+    raise their last error. With a deadline, the attempts are cut at the
+    deadline and no retry is made which would start after it. The
+    deadline is a loop time given to `call`, or `timeout` seconds after
+    the call.
+
+    Every attempt is a `<name>_attempt` child span of the caller's span,
+    tagged with the attempt number and the delay waited before it, and is
+    passed as `ctx` to the function.
+
+        retry = Retry(loop, 'billing', budget=billing_budget)
+        result = await retry.call(ctx, client.get, url)
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 name: str = 'retry', attempts: int = 3,
+                 base_delay: float = 0.1, max_delay: float = 10.,
+                 multiplier: float = 2., jitter: float = 1.,
+                 retry_on: Tuple[Type[BaseException], ...] = (
+                     OSError, asyncio.TimeoutError),
+                 budget: Optional[RetryBudget] = None,
+                 timeout: Optional[float] = None) -> None:
+        if attempts < 1 or not 0 <= jitter <= 1:
+            raise UserWarning('Invalid retry settings')
+        self.loop = loop
+        self.name = name
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.retry_on = retry_on
+        self.budget = budget
+        self.timeout = timeout
+
+    def should_retry(self, err: BaseException) -> bool:
+        return isinstance(err, self.retry_on)
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Delay before retrying the `attempt`th attempt
+        """
+        delay = min(self.max_delay,
+                    self.base_delay * self.multiplier ** (attempt - 1))
+        return delay * (1. - self.jitter * random.random())
+
+    async def call(self, ctx: Span, func: Callable, *args: Any,
+                   deadline: Optional[float] = None, **kwargs: Any) -> Any:
+        """
+        Awaits `func(attempt_ctx, *args, **kwargs)` until it succeeds
+        """
+        if deadline is None and self.timeout is not None:
+            deadline = self.loop.time() + self.timeout
+        if self.budget is not None:
+            self.budget.record_call()
+        attempt = 1
+        delay = 0.
+        while True:
+            span = ctx.new_child('%s_attempt' % self.name)
+            span.tag('retry.attempt', attempt)
+            span.tag('retry.delay', round(delay, 6))
+            try:
+                with span:
+                    if deadline is None:
+                        return await func(span, *args, **kwargs)
+                    remaining = deadline - self.loop.time()
+                    if remaining <= 0:
+                        raise asyncio.TimeoutError()
+                    return await asyncio.wait_for(
+                        func(span, *args, **kwargs), remaining,
+                        loop=self.loop)
+            except asyncio.CancelledError:
+                # an Exception on python 3.6, never retried
+                raise
+            except Exception as err:
+                if attempt >= self.attempts or not self.should_retry(err):
+                    raise
+                delay = self.backoff(attempt)
+                if (deadline is not None and
+                        self.loop.time() + delay >= deadline):
+                    ctx.annotate('%s retry after deadline' % self.name)
+                    raise
+                if self.budget is not None and not self.budget.try_retry():
+                    ctx.annotate('%s retry budget exhausted' % self.name)
+                    raise
+            await asyncio.sleep(delay, loop=self.loop)
+            attempt += 1
@@ -0,0 +1,262 @@
+import math
+import asyncio
+import datetime
+from typing import Optional, Callable, Any, Dict, List, Union
+from .tracer import Tracer
+
+Delay = Union[float, datetime.timedelta]
+
+
+class TimerHandle:
+    __slots__ = ('scheduler', 'when', 'tick', 'callback', 'args', 'kwargs',
+                 'future', '_bucket', '_level', '_cancelled', '_done')
+
+    def __init__(self, scheduler: 'Scheduler', when: float, tick: int,
+                 callback: Callable, args: tuple, kwargs: dict) -> None:
+        self.scheduler = scheduler
+        self.when = when
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        # task of the coroutine returned by the callback
+        self.future: Optional[asyncio.Future] = None
+        self._bucket: Optional[Dict['TimerHandle', None]] = None
+        self._level = 0
+        self._cancelled = False
+        self._done = False
+
+    def cancel(self) -> None:
+        if self._bucket is not None:
+            del self._bucket[self]
+            self._bucket = None
+            self.scheduler._discard(self)
+        self._cancelled = True
+
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def done(self) -> bool:
+        return self._done or self._cancelled
+
+    def __repr__(self) -> str:
+        state = ('cancelled' if self._cancelled else
+                 'done' if self._done else 'pending')
+        return '<TimerHandle %s when=%.3f %r>' % (state, self.when,
+                                                  self.callback)
+
+
+class Scheduler:
+    """
+    Delayed calls on a hierarchical timer wheel.
+
+    Time is divided into ticks of `resolution` seconds. The wheel has
+    `levels` levels of 2 ** `bits` slots, a slot of level N spans
+    2 ** (bits * N) ticks. A timer goes into the slot of the lowest level
+    which covers its delay and moves down a level each time the wheel
+    reaches its slot, so scheduling and cancelling is O(1) whatever the
+    number of pending timers.
+
+    All timers of a tick run from a single loop callback, none of them runs
+    before its time and they run at most one tick late. The loop is woken
+    up only while timers are pending. Callbacks returning a coroutine get
+    it scheduled as a task, like `misc.async_call` does.
+
+    The number of pending timers is reported as `<name>_pending` gauge at
+    most every `stats_interval` seconds.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 tracer: Optional[Tracer] = None,
+                 resolution: float = 0.01, bits: int = 8, levels: int = 4,
+                 name: str = 'scheduler',
+                 stats_interval: float = 10.) -> None:
+        self.loop = loop
+        self.resolution = resolution
+        self.bits = bits
+        self.levels = levels
+        self.stats_interval = stats_interval
+        self._size = 1 << bits
+        self._mask = self._size - 1
+        self._wheel: List[List[Dict[TimerHandle, None]]] = [
+            [{} for _ in range(self._size)] for _ in range(levels)]
+        self._counts = [0] * levels
+        self._tick = 0
+        self._pending = 0
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+        self._wakeup_tick = 0
+        self._fired = 0
+        self._cancels = 0
+        self._ticks = 0
+        self._gauge = (tracer.gauge('%s_pending' % name)
+                       if tracer is not None else None)
+        self._gauge_stamp = 0.
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'pending': self._pending,
+            'fired': self._fired,
+            'cancelled': self._cancels,
+            'ticks': self._ticks,
+        }
+
+    def call_later(self, delay: Delay, callback: Callable, *args: Any,
+                   **kwargs: Any) -> TimerHandle:
+        if isinstance(delay, datetime.timedelta):
+            delay = delay.total_seconds()
+        return self.call_at(self.loop.time() + delay, callback, *args,
+                            **kwargs)
+
+    def call_at(self, when: float, callback: Callable, *args: Any,
+                **kwargs: Any) -> TimerHandle:
+        if self._pending == 0:
+            self._tick = int(self.loop.time() / self.resolution)
+        # never fire early: the tick starting at or after `when`
+        tick = max(int(math.ceil(when / self.resolution)), self._tick + 1)
+        handle = TimerHandle(self, when, tick, callback, args, kwargs)
+        self._insert(handle)
+        self._pending += 1
+        if handle._level:
+            # woken up to cascade it
+            span = 1 << (self.bits * handle._level)
+            tick = (self._tick // span + 1) * span
+        if self._wakeup is None or tick < self._wakeup_tick:
+            self._schedule_wakeup(tick)
+        return handle
+
+    def close(self) -> None:
+        for level in self._wheel:
+            for bucket in level:
+                for handle in list(bucket):
+                    handle._bucket = None
+                    handle._cancelled = True
+                bucket.clear()
+        self._counts = [0] * self.levels
+        self._pending = 0
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+        self._report()
+
+    def _insert(self, handle: TimerHandle) -> None:
+        tick = handle.tick
+        delta = tick - self._tick
+        if delta <= 0:
+            tick = self._tick
+            level = 0
+        else:
+            level = (delta.bit_length() - 1) // self.bits
+            if level >= self.levels:
+                # beyond the wheel, park it in the farthest slot and let it
+                # cascade from there
+                level = self.levels - 1
+                tick = self._tick + (self._mask << (self.bits * level))
+        bucket = self._wheel[level][(tick >> (self.bits * level)) &
+                                    self._mask]
+        bucket[handle] = None
+        handle._bucket = bucket
+        handle._level = level
+        self._counts[level] += 1
+
+    def _discard(self, handle: TimerHandle) -> None:
+        self._counts[handle._level] -= 1
+        self._pending -= 1
+        self._cancels += 1
+        if self._pending == 0 and self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+            self._report()
+
+    def _schedule_wakeup(self, tick: int) -> None:
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+        self._wakeup_tick = tick
+        self._wakeup = self.loop.call_at(tick * self.resolution, self._run)
+
+    def _next_tick(self) -> int:
+        """
+        The first tick with timers to fire or to cascade, the ticks in
+        between are skipped
+        """
+        tick = self._tick + self._size
+        if self._counts[0]:
+            slots = self._wheel[0]
+            for offset in range(1, self._size):
+                if slots[(self._tick + offset) & self._mask]:
+                    tick = self._tick + offset
+                    break
+        # the next boundary of the lowest non-empty level comes before the
+        # boundaries of the higher ones
+        for level in range(1, self.levels):
+            if self._counts[level]:
+                span = 1 << (self.bits * level)
+                return min(tick, (self._tick // span + 1) * span)
+        return tick
+
+    def _run(self) -> None:
+        self._wakeup = None
+        now = int(self.loop.time() / self.resolution)
+        while self._pending:
+            tick = self._next_tick()
+            if tick > now:
+                break
+            self._tick = tick
+            self._ticks += 1
+            self._cascade()
+            bucket = self._wheel[0][tick & self._mask]
+            if bucket:
+                self._fire(bucket)
+        if self._pending:
+            self._schedule_wakeup(self._next_tick())
+        if (self._pending == 0 or
+                self.loop.time() - self._gauge_stamp >= self.stats_interval):
+            self._report()
+
+    def _cascade(self) -> None:
+        for level in range(self.levels - 1, 0, -1):
+            shift = self.bits * level
+            if self._tick & ((1 << shift) - 1):
+                continue
+            slots = self._wheel[level]
+            idx = (self._tick >> shift) & self._mask
+            bucket = slots[idx]
+            if not bucket:
+                continue
+            slots[idx] = {}
+            self._counts[level] -= len(bucket)
+            for handle in bucket:
+                self._insert(handle)
+
+    def _fire(self, bucket: Dict[TimerHandle, None]) -> None:
+        self._wheel[0][self._tick & self._mask] = {}
+        self._counts[0] -= len(bucket)
+        self._pending -= len(bucket)
+        handles = list(bucket)
+        for handle in handles:
+            handle._bucket = None
+        for handle in handles:
+            if handle._cancelled:
+                # cancelled by a callback of the same tick
+                continue
+            handle._done = True
+            self._fired += 1
+            try:
+                res = handle.callback(*handle.args, **handle.kwargs)
+                if asyncio.iscoroutine(res):
+                    handle.future = asyncio.ensure_future(res, loop=self.loop)
+            except Exception as exc:
+                self.loop.call_exception_handler({
+                    'message': 'Exception in scheduled callback %r'
+                               '' % handle.callback,
+                    'exception': exc,
+                    'handle': handle,
+                })
+
+    def _report(self) -> None:
+        self._gauge_stamp = self.loop.time()
+        if self._gauge is not None:
+            self._gauge.set(self._pending)
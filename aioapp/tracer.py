@@ -1,18 +1,29 @@
-from typing import Optional, Any, Callable, List
+from typing import Optional, Any, Callable, List, Tuple, Dict, Iterable
+import collections
+from collections import deque, OrderedDict
+from bisect import bisect_left
 from yarl import URL
+import os
+import sys
+import socket
 import time
 import re
 import asyncio
+import random
+import threading
 import aioapp.app  # noqa
 import aiozipkin as az
 import aiozipkin.tracer as azt
 import aiozipkin.span as azs
 import aiozipkin.helpers as azh
 import aiozipkin.utils as azu
-from .misc import async_call
+from .metrics import (Aggregator, SeriesKey, Counter, Gauge, Histogram,
+                      Timer, Registry, DEFAULT_BUCKETS, CardinalityLimiter)
 
 STATS_CLEAN_NAME_RE = re.compile('[^0-9a-zA-Z_.-]')
 STATS_CLEAN_TAG_RE = re.compile('[^0-9a-zA-Z_=.-]')
+STATS_ESCAPE_RE = re.compile('[\n, ]')
+STATS_ESCAPES = {'\n': '', ',': '\\,', ' ': '\\ '}
 
 DRIVER_ZIPKIN = 'zipkin'
 
@@ -55,6 +66,10 @@ MESSAGE_ADDR = 'ma'
 SERVER_ADDR = 'sa'
 
 
+def _escape_match(match) -> str:
+    return STATS_ESCAPES[match.group()]
+
+
 class Span:
     def __init__(self,
                  tracer: Optional['Tracer'],
@@ -88,6 +103,7 @@ class Span:
         self._exception: Optional[Exception] = None
         self._children: List['Span'] = []
         self._sent = False
+        self._profiled = False
 
     def skip(self):
         self._skip = True
@@ -139,8 +155,20 @@ class Span:
             self.tag('error', 'true', True)
             self.tag('error.message', str(exception))
 
+        if self._profiled:
+            self._profiled = False
+            if self.tracer is not None and self.tracer.profiler is not None:
+                self.tracer.profiler.finish(self)
+
         if self.parent is None:
             self._send_span()
+            if (self.tracer is not None and not self._skip
+                    and self.tracer.trace_store is not None):
+                self.tracer.trace_store.add(self)
+
+        if (self.tracer is not None and self.tracer.registry is not None
+                and not self._skip):
+            self.tracer.registry.observe_span(self)
 
         if self.metrics and not self._skip:
             self.metrics.send(self)
@@ -195,6 +223,19 @@ class Span:
         self._annotations.append((value, int((ts or time.time()) * 1000000)))
         return self
 
+    def profile(self) -> 'Span':
+        """
+        Sample the event loop thread while this span is open.
+        Stack samples are attached only if the span turns out to be slower
+        than the profiler threshold. Does nothing if the profiler is not set
+        up with Tracer.setup_profiler
+        """
+        if (not self._profiled and self.tracer is not None
+                and self.tracer.profiler is not None):
+            self._profiled = True
+            self.tracer.profiler.start(self)
+        return self
+
     def kind(self, span_kind: str) -> 'Span':
         self._kind = span_kind
         return self
@@ -249,6 +290,9 @@ class Tracer:
         self.loop = loop
         self.tracer: Optional[az.Tracer] = None
         self.metrics: Optional[InfluxMetrics] = None
+        self.profiler: Optional[SpanProfiler] = None
+        self.trace_store: Optional[TraceStore] = None
+        self.registry: Optional[Registry] = None
         self.tracer_driver: Optional[str] = None
         self.default_sampled: Optional[bool] = None
         self.default_debug: Optional[bool] = None
@@ -327,95 +371,817 @@ class Tracer:
                                   loop=self.loop)
         self.tracer = az.Tracer(transport, sampler, endpoint)
 
-    def setup_metrics(self, driver: str, addr: str, name: str) -> None:
+    def setup_metrics(self, driver: str, addr: str, name: str,
+                      max_packet_size: int = 1432,
+                      flush_interval: float = 0.1,
+                      aggregate: bool = False,
+                      aggregate_interval: float = 10.,
+                      max_tag_values: Optional[int] = None,
+                      tag_limits: Optional[Dict[str, int]] = None,
+                      stats_interval: Optional[float] = None,
+                      sample_rate: float = 1.,
+                      sample_rates: Optional[Dict[str, float]] = None
+                      ) -> None:
         if driver not in ('telegraf-influx', 'statsd-influx'):
             raise UserWarning('Unsupported metrics driver')
         url = URL(addr)
-        self.metrics = InfluxMetrics(self, url, name, driver, self.loop)
+        self.metrics = InfluxMetrics(self, url, name, driver, self.loop,
+                                     max_packet_size=max_packet_size,
+                                     flush_interval=flush_interval,
+                                     aggregate=aggregate,
+                                     aggregate_interval=aggregate_interval,
+                                     max_tag_values=max_tag_values,
+                                     tag_limits=tag_limits,
+                                     stats_interval=stats_interval,
+                                     sample_rate=sample_rate,
+                                     sample_rates=sample_rates)
+
+    def setup_registry(self, prefix: str = '',
+                       buckets: Iterable[float] = DEFAULT_BUCKETS,
+                       max_tag_values: Optional[int] = None,
+                       tag_limits: Optional[Dict[str, int]] = None) -> None:
+        self.registry = Registry(prefix=prefix, buckets=buckets,
+                                 max_tag_values=max_tag_values,
+                                 tag_limits=tag_limits)
+
+    def counter(self, name: str, tags: Optional[dict] = None) -> Counter:
+        return Counter(self, name, tags)
+
+    def gauge(self, name: str, tags: Optional[dict] = None) -> Gauge:
+        return Gauge(self, name, tags)
+
+    def histogram(self, name: str, tags: Optional[dict] = None
+                  ) -> Histogram:
+        return Histogram(self, name, tags)
+
+    def timer(self, name: str, tags: Optional[dict] = None) -> Timer:
+        return Timer(self, name, tags)
+
+    def setup_profiler(self, threshold: float, interval: float = 0.005,
+                       top: int = 10, dump_dir: Optional[str] = None
+                       ) -> None:
+        self.profiler = SpanProfiler(self, threshold, interval=interval,
+                                     top=top, dump_dir=dump_dir)
+
+    def setup_trace_store(self, size: int = 100, max_names: int = 64,
+                          buckets: Optional[Iterable[float]] = None,
+                          max_spans: int = 100) -> None:
+        self.trace_store = TraceStore(size=size, max_names=max_names,
+                                      buckets=buckets, max_spans=max_spans)
+
+    def slowest_traces(self, limit: int = 10,
+                       name: Optional[str] = None) -> List[Span]:
+        if self.trace_store is None:
+            return []
+        return self.trace_store.slowest(limit, name)
+
+    def errored_traces(self, limit: int = 10,
+                       name: Optional[str] = None) -> List[Span]:
+        if self.trace_store is None:
+            return []
+        return self.trace_store.errored(limit, name)
+
+    def traces_with_tag(self, key: str, value: Optional[str] = None,
+                        limit: int = 10) -> List[Span]:
+        if self.trace_store is None:
+            return []
+        return self.trace_store.with_tag(key, value, limit)
 
     async def close(self):
-        if self.tracer:
-            await self.tracer.close()
         if self.metrics:
             await self.metrics.close()
+        if self.tracer:
+            await self.tracer.close()
+        if self.profiler:
+            self.profiler.close()
+
+
+class TraceStore:
+    """
+    Bounded in-memory store of recently finished root spans (with their
+    children), regardless of sampling.
+
+    Every root span is appended to a ring buffer of its name, to a ring
+    buffer of its latency bucket and, if it failed, to a ring buffer of
+    errors. Each buffer holds at most `size` traces and at most `max_names`
+    names are tracked, the rest share the OTHER buffer, so the store never
+    keeps more than (max_names + 1 + buckets + 1) * size traces.
+
+    A stored trace keeps at most `max_spans` spans (breadth first), the
+    number of spans dropped from it is tagged as `trace.dropped_spans` on
+    the root span.
+    """
+
+    OTHER = '__other__'
+    DEFAULT_BUCKETS = DEFAULT_BUCKETS
+
+    def __init__(self, size: int = 100, max_names: int = 64,
+                 buckets: Optional[Iterable[float]] = None,
+                 max_spans: int = 100) -> None:
+        if max_spans < 1:
+            raise UserWarning('Invalid max_spans')
+        self.size = size
+        self.max_names = max_names
+        self.max_spans = max_spans
+        self._bounds = [int(b * 1000000)
+                        for b in sorted(buckets or self.DEFAULT_BUCKETS)]
+        self._by_name: Dict[str, deque] = {}
+        self._by_bucket = [deque(maxlen=size)
+                           for _ in range(len(self._bounds) + 1)]
+        self._errors: deque = deque(maxlen=size)
+
+    @staticmethod
+    def _duration(span: Span) -> int:
+        if span._start_stamp is None or span._finish_stamp is None:
+            return 0
+        return span._finish_stamp - span._start_stamp
+
+    def add(self, span: Span) -> None:
+        self._truncate(span)
+        name = span._name or ''
+        buf = self._by_name.get(name)
+        if buf is None:
+            if len(self._by_name) >= self.max_names:
+                name = self.OTHER
+                buf = self._by_name.get(name)
+            if buf is None:
+                buf = self._by_name[name] = deque(maxlen=self.size)
+        buf.append(span)
+        idx = bisect_left(self._bounds, self._duration(span))
+        self._by_bucket[idx].append(span)
+        if span._exception is not None or span._tags.get(ERROR) == 'true':
+            self._errors.append(span)
+
+    def _truncate(self, span: Span) -> None:
+        kept = 1
+        dropped = 0
+        queue = deque([span])
+        while queue:
+            parent = queue.popleft()
+            room = self.max_spans - kept
+            if len(parent._children) > room:
+                for child in parent._children[room:]:
+                    dropped += self._count(child)
+                parent._children = parent._children[:room]
+            kept += len(parent._children)
+            queue.extend(parent._children)
+        if dropped:
+            span.tag('trace.dropped_spans', dropped)
+
+    def _count(self, span: Span) -> int:
+        return 1 + sum(self._count(child) for child in span._children)
+
+    def slowest(self, limit: int = 10,
+                name: Optional[str] = None) -> List[Span]:
+        if name is not None:
+            candidates = list(self._by_name.get(name, ()))
+        else:
+            candidates = []
+            for bucket in reversed(self._by_bucket):
+                candidates.extend(bucket)
+                if len(candidates) >= limit:
+                    break
+        candidates.sort(key=self._duration, reverse=True)
+        return candidates[:limit]
+
+    def errored(self, limit: int = 10,
+                name: Optional[str] = None) -> List[Span]:
+        result = []
+        for span in reversed(self._errors):
+            if name is None or span._name == name:
+                result.append(span)
+                if len(result) >= limit:
+                    break
+        return result
+
+    def with_tag(self, key: str, value: Optional[str] = None,
+                 limit: int = 10) -> List[Span]:
+        """
+        Most recent traces having a span tagged with `key` (equal to
+        `value` if given)
+        """
+        spans = [span for buf in self._by_name.values() for span in buf]
+        spans.sort(key=lambda span: span._finish_stamp or 0, reverse=True)
+        result = []
+        for span in spans:
+            if self._has_tag(span, key, value):
+                result.append(span)
+                if len(result) >= limit:
+                    break
+        return result
+
+    def _has_tag(self, span: Span, key: str, value: Optional[str]) -> bool:
+        if key in span._tags and (value is None
+                                  or span._tags[key] == value):
+            return True
+        return any(self._has_tag(child, key, value)
+                   for child in span._children)
+
+
+class SpanProfiler:
+    """
+    Sampling profiler of the event loop thread.
+
+    A background thread takes a stack sample of the loop thread every
+    `interval` seconds, but only while at least one span marked with
+    Span.profile() is open. When such a span finishes later than `threshold`
+    seconds after its start, samples taken during its lifetime are aggregated
+    and the `top` most frequent stacks are attached to the span as
+    annotations. If `dump_dir` is set, all aggregated stacks are also written
+    to `<dump_dir>/<trace_id>.folded` in the collapsed format understood by
+    flamegraph tools.
+    """
+
+    max_depth = 64
+    annotate_depth = 8
+
+    def __init__(self, tracer: Tracer, threshold: float,
+                 interval: float = 0.005, top: int = 10,
+                 dump_dir: Optional[str] = None,
+                 max_samples: int = 20000) -> None:
+        self.tracer = tracer
+        self.threshold = int(threshold * 1000000)
+        self.interval = interval
+        self.top = top
+        self.dump_dir = dump_dir
+        self._samples: deque = deque(maxlen=max_samples)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._active = 0
+        self._thread_id: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._closing = False
+
+    def start(self, span: Span) -> None:
+        with self._lock:
+            self._active += 1
+            self._thread_id = threading.get_ident()
+        if self._thread is None and not self._closing:
+            self._thread = threading.Thread(target=self._run,
+                                            name='aioapp-profiler',
+                                            daemon=True)
+            self._thread.start()
+        self._wakeup.set()
+
+    def finish(self, span: Span) -> None:
+        with self._lock:
+            self._active -= 1
+            if self._active <= 0:
+                self._active = 0
+                self._wakeup.clear()
+        if span._start_stamp is None or span._finish_stamp is None:
+            return
+        if span._finish_stamp - span._start_stamp < self.threshold:
+            return
+        stacks = self._collect(span._start_stamp, span._finish_stamp)
+        if not stacks:
+            return
+        total = sum(stacks.values())
+        for stack, count in stacks.most_common(self.top):
+            span.annotate('profile: %s/%s %s' % (
+                count, total,
+                self._format(stack[-self.annotate_depth:])))
+        if self.dump_dir is not None:
+            self.tracer.loop.run_in_executor(None, self._dump,
+                                             span.trace_id, stacks)
+
+    def _run(self) -> None:
+        while not self._closing:
+            self._wakeup.wait()
+            if self._closing:
+                break
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is not None:
+                stack: List[Tuple[str, str, int]] = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_name,
+                                  frame.f_lineno))
+                    frame = frame.f_back
+                del frame
+                stack.reverse()
+                with self._lock:
+                    if self._active:
+                        self._samples.append((int(time.time() * 1000000),
+                                              tuple(stack)))
+            time.sleep(self.interval)
+
+    def _collect(self, start: int, finish: int) -> collections.Counter:
+        with self._lock:
+            samples = list(self._samples)
+            if not self._active:
+                self._samples.clear()
+        return collections.Counter(stack for stamp, stack in samples
+                                   if start <= stamp <= finish)
+
+    @staticmethod
+    def _format(stack: tuple) -> str:
+        return ';'.join('%s:%s:%s' % (os.path.basename(filename), name,
+                                      lineno)
+                        for filename, name, lineno in stack)
+
+    def _dump(self, trace_id: str, stacks: collections.Counter) -> None:
+        path = os.path.join(self.dump_dir, '%s.folded' % trace_id)
+        with open(path, 'a') as f:
+            for stack, count in stacks.items():
+                f.write('%s %s\n' % (self._format(stack), count))
+
+    def close(self) -> None:
+        self._closing = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
 
 
 class InfluxMetrics:
+    """
+    Sends span durations to telegraf or statsd.
+
+    Encoded lines are buffered and sent as multi-line datagrams of at most
+    `max_packet_size` bytes (the default fits into an ethernet MTU). The
+    buffer is flushed when the next line does not fit or `flush_interval`
+    seconds after the first buffered line. `max_packet_size=0` sends every
+    line in its own datagram.
+
+    With `aggregate=True` nothing is sent per span. Durations are summarized
+    per series in memory and every `aggregate_interval` seconds each series
+    is sent as one telegraf line with count, sum, min, max and percentile
+    fields. Statsd has no such type, so there every statistic is sent as
+    `<name>.<stat>` gauge (`<name>.count` as a counter). Telegraf also gets
+    an exemplar trace id per series and latency bucket as
+    `<name>_exemplar,<tags>,le=<bucket> trace_id="...",value=...` lines.
+
+    Supported addresses are udp://host:port, tcp://host:port,
+    unix:///path/to/stream.sock and unixgram:///path/to/datagram.sock.
+    Payloads which can not be sent right away (not connected yet,
+    reconnecting or paused by the transport flow control) are kept in a
+    buffer of at most `max_buffer_size` bytes, dropping the oldest ones.
+    Lost connections are reestablished with exponential backoff.
+
+    Every tag of a metric name takes at most `max_tag_values` distinct
+    values (or the number given for the name in `tag_limits`), the following
+    ones are reported as `__other__`. There is no limit by default.
+
+    Counters of sent and dropped lines, the send buffer high-water mark,
+    reconnects and send errors are available from stats(). With
+    `stats_interval`, they are also sent as the `aioapp_metrics` series
+    every `stats_interval` seconds.
+
+    Span durations can be sampled with `sample_rate`, or per metric name
+    with `sample_rates`. Statsd lines of sampled spans carry the `|@rate`
+    suffix and telegraf lines a `weight=1/rate` field, so counts can be
+    extrapolated. Sampling does not apply in aggregation mode.
+    """
+
+    SCHEMES = ('udp', 'tcp', 'unix', 'unixgram')
+    reconnect_delay_min = 0.1
+    reconnect_delay_max = 30.
 
     def __init__(self, tracer: Tracer, url: URL, name: Optional[str],
-                 format: str, loop: asyncio.AbstractEventLoop) -> None:
+                 format: str, loop: asyncio.AbstractEventLoop,
+                 max_packet_size: int = 1432,
+                 flush_interval: float = 0.1,
+                 aggregate: bool = False,
+                 aggregate_interval: float = 10.,
+                 percentiles: Iterable[float] = (50, 90, 99),
+                 max_buffer_size: int = 1048576,
+                 series_cache_size: int = 1024,
+                 max_tag_values: Optional[int] = None,
+                 tag_limits: Optional[Dict[str, int]] = None,
+                 stats_interval: Optional[float] = None,
+                 sample_rate: float = 1.,
+                 sample_rates: Optional[Dict[str, float]] = None) -> None:
+        if url.scheme not in self.SCHEMES:
+            raise NotImplementedError(str(url))
         self.tracer = tracer
         self.name = name
         self.url = url
         self.format = format
         self.loop = loop
+        self.max_packet_size = max_packet_size
+        self.flush_interval = flush_interval
+        self.sample_rate = sample_rate
+        self.sample_rates = sample_rates or {}
         self.transport = None
+        self.protocol = None
         self.closing = False
+        self.max_buffer_size = max_buffer_size
+        self._pending: deque = deque()
+        self._pending_size = 0
+        self._paused = False
+        self._reconnect_delay = self.reconnect_delay_min
+        self._reconnect_handle: Optional[asyncio.Handle] = None
+        self._connect_task: Optional[asyncio.Future] = None
+        self.series_cache_size = series_cache_size
+        self.limiter: Optional[CardinalityLimiter] = None
+        if max_tag_values is not None:
+            self.limiter = CardinalityLimiter(max_tag_values, tag_limits,
+                                              on_overflow=self._on_overflow)
+        self._series_cache: OrderedDict = OrderedDict()
+        self._buf: List[bytes] = []
+        self._buf_size = 0
+        self._flush_handle: Optional[asyncio.Handle] = None
+        self.aggregate_interval = aggregate_interval
+        self.percentiles = tuple(percentiles)
+        self._aggregator: Optional[Aggregator] = None
+        self._aggregate_handle: Optional[asyncio.Handle] = None
+        if aggregate:
+            self._aggregator = Aggregator(exemplar_buckets=[
+                int(bound * 1000000) for bound in DEFAULT_BUCKETS])
+            self._aggregate_handle = self.loop.call_later(
+                self.aggregate_interval, self.flush_aggregates)
+        self.stats_interval = stats_interval
+        self._stats_handle: Optional[asyncio.Handle] = None
+        self._lines_sent = 0
+        self._bytes_sent = 0
+        self._packets_sent = 0
+        self._lines_dropped = {'buffer_full': 0, 'closed': 0}
+        self._buffer_high_water = 0
+        self._reconnects = 0
+        self._send_errors = 0
+        if stats_interval:
+            self._stats_handle = self.loop.call_later(stats_interval,
+                                                      self.send_stats)
         self._connect()
 
     def _connect(self):
-        if self.url.scheme == 'udp':
-            asyncio.ensure_future(self._async_conn(), loop=self.loop)
-        else:
-            raise NotImplementedError(str(self.url))
+        self._reconnect_handle = None
+        if not self.closing:
+            self._connect_task = asyncio.ensure_future(self._async_conn(),
+                                                       loop=self.loop)
 
     async def _async_conn(self):
-        connect = self.loop.create_datagram_endpoint(
-            lambda: self,
-            remote_addr=(self.url.host, self.url.port))
-        self.transport, self.protocol = await connect
+        scheme = self.url.scheme
+        if scheme == 'udp':
+            connect = self.loop.create_datagram_endpoint(
+                lambda: self,
+                remote_addr=(self.url.host, self.url.port))
+        elif scheme == 'tcp':
+            connect = self.loop.create_connection(
+                lambda: self, self.url.host, self.url.port)
+        elif scheme == 'unix':
+            connect = self.loop.create_unix_connection(
+                lambda: self, self.url.path)
+        try:
+            if scheme == 'unixgram':
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                try:
+                    sock.setblocking(False)
+                    sock.connect(self.url.path)
+                except OSError:
+                    sock.close()
+                    raise
+                connect = self.loop.create_datagram_endpoint(lambda: self,
+                                                             sock=sock)
+            self.transport, self.protocol = await connect
+        except OSError as err:
+            self.tracer.app.log_err(err)
+            self._reconnect()
+        finally:
+            self._connect_task = None
+
+    def _reconnect(self):
+        if self.closing or self._reconnect_handle is not None:
+            return
+        self._reconnects += 1
+        self._reconnect_handle = self.loop.call_later(self._reconnect_delay,
+                                                      self._connect)
+        self._reconnect_delay = min(self._reconnect_delay * 2,
+                                    self.reconnect_delay_max)
 
     def _escape_name(self, name):
-        name = name.replace('\n', '')
-        name = name.replace(',', '\\,')
-        name = name.replace(' ', '\\ ')
-        return name
+        name = str(name)
+        if STATS_ESCAPE_RE.search(name) is None:
+            return name
+        return STATS_ESCAPE_RE.sub(_escape_match, name)
 
     def send(self, span: Span):
-        if self.transport:
-            if SPAN_TYPE in span._tags_metrics:
-                name = self._escape_name(span._tags_metrics.pop(SPAN_TYPE))
-            else:
-                name = self._escape_name(span._name)
-            if self.name:
-                name = self.name + name
-            tags = []
-            for key, value in span._tags_metrics.items():
-                tag = '%s=%s' % (self._escape_name(key),
-                                 self._escape_name(value))
-                tags.append(tag)
+        if not self.closing:
+            rate = 1.
+            if self._aggregator is None and (self.sample_rate < 1.
+                                             or self.sample_rates):
+                rate = self.sample_rates.get(
+                    span._tags_metrics.get(SPAN_TYPE, span._name),
+                    self.sample_rate)
+                if rate < 1. and random.random() >= rate:  # nosec
+                    return
 
+            key = self._series_key(span)
             duration = span._finish_stamp - span._start_stamp
 
+            if self._aggregator is not None:
+                self._aggregator.timer(key, duration, span.trace_id,
+                                       bool(span.sampled))
+                return
+
+            name, tags = key
             if tags:
-                name = name + ',' + (','.join(tags))
-            
+                name = name + ',' + tags
+
             if self.format == 'telegraf-influx':
-                line = '%s duration=%s %s\n' % (name,
-                                                duration,
-                                                span._finish_stamp * 1000)
+                if rate < 1.:
+                    line = '%s duration=%s,weight=%s %s\n' % (
+                        name, duration, 1. / rate, span._finish_stamp * 1000)
+                else:
+                    line = '%s duration=%s %s\n' % (name,
+                                                    duration,
+                                                    span._finish_stamp * 1000)
+            elif rate < 1.:
+                line = '%s:%s|ms|@%s\n' % (name, duration, rate)
             else:
                 line = '%s:%s|ms\n' % (name,
                                        duration)
-                                       
-            self.transport.sendto(line.encode())
+
+            self._write(line.encode())
+        else:
+            self._lines_dropped['closed'] += 1
+
+    def _series_key(self, span: Span) -> SeriesKey:
+        if SPAN_TYPE in span._tags_metrics:
+            name = span._tags_metrics.pop(SPAN_TYPE)
+        else:
+            name = span._name
+        return self.series_key(name, span._tags_metrics)
+
+    def series_key(self, name: str, tags: Optional[dict] = None
+                   ) -> SeriesKey:
+        """
+        Escaped name with prefix and escaped tags sorted by key.
+        Results are cached in a LRU of `series_cache_size` entries
+        """
+        if tags and self.limiter is not None:
+            tags = self.limiter.limit(name, tags)
+        items = tuple(sorted(tags.items())) if tags else ()
+        cache = self._series_cache
+        cache_key = (name, items)
+        series = cache.get(cache_key)
+        if series is not None:
+            cache.move_to_end(cache_key)
+            return series
+
+        _name = self._escape_name(name)
+        if self.name:
+            _name = self.name + _name
+        series = (_name, ','.join('%s=%s' % (self._escape_name(key),
+                                             self._escape_name(value))
+                                  for key, value in items))
+        if self.series_cache_size > 0:
+            cache[cache_key] = series
+            if len(cache) > self.series_cache_size:
+                cache.popitem(last=False)
+        return series
+
+    def _on_overflow(self, name: str, key: str) -> None:
+        self.tracer.app.log_warn('Metric %s has too many values of tag %s, '
+                                 'new ones are reported as %s'
+                                 '' % (name, key, CardinalityLimiter.OTHER))
+
+    def cardinality_overflow(self) -> Dict[str, List[str]]:
+        if self.limiter is None:
+            return {}
+        return self.limiter.overflow()
+
+    def count(self, key: SeriesKey, value: float = 1) -> None:
+        if self._aggregator is not None:
+            self._aggregator.count(key, value)
+        else:
+            self._write_value(key, 'count', value, 'c')
+
+    def gauge(self, key: SeriesKey, value: float) -> None:
+        if self._aggregator is not None:
+            self._aggregator.gauge(key, value)
+        else:
+            if value < 0 and self.format != 'telegraf-influx':
+                # a signed statsd gauge is a relative change
+                self._write_value(key, 'value', 0, 'g')
+            self._write_value(key, 'value', value, 'g')
+
+    def histogram(self, key: SeriesKey, value: float) -> None:
+        if self._aggregator is not None:
+            self._aggregator.timer(key, value)
+        else:
+            self._write_value(key, 'value', value, 'h')
+
+    def timer(self, key: SeriesKey, value: float,
+              trace_id: Optional[str] = None, sampled: bool = False) -> None:
+        """
+        :param value: duration in microseconds
+        :param trace_id: trace to keep as exemplar in aggregation mode
+        """
+        if self._aggregator is not None:
+            self._aggregator.timer(key, value, trace_id, sampled)
+        else:
+            self._write_value(key, 'duration', value, 'ms')
+
+    def _write_value(self, key: SeriesKey, field: str, value: float,
+                     statsd_type: str) -> None:
+        if self.format == 'telegraf-influx':
+            self._write_fields(key, '%s=%s' % (field, value),
+                               int(time.time() * 1000000000))
+        else:
+            self._write_statsd(key, '%s|%s' % (value, statsd_type))
+
+    def flush_aggregates(self) -> None:
+        if self._aggregate_handle is not None:
+            self._aggregate_handle.cancel()
+            self._aggregate_handle = None
+        if self._aggregator is None:
+            return
+        if not self.closing:
+            self._aggregate_handle = self.loop.call_later(
+                self.aggregate_interval, self.flush_aggregates)
+        counters, gauges, timers = self._aggregator.reset()
+        if self.format == 'telegraf-influx':
+            stamp = int(time.time() * 1000000000)
+            for key, value in counters.items():
+                self._write_fields(key, 'count=%s' % value, stamp)
+            for key, value in gauges.items():
+                self._write_fields(key, 'value=%s' % value, stamp)
+            for key, stats in timers.items():
+                fields = ['count=%s' % stats.count, 'sum=%s' % stats.sum,
+                          'min=%s' % stats.min, 'max=%s' % stats.max]
+                for p, value in zip(self.percentiles,
+                                    stats.percentiles(self.percentiles)):
+                    fields.append('p%s=%s' % (p, value))
+                self._write_fields(key, ','.join(fields), stamp)
+            self._write_exemplars(stamp)
+        else:
+            for key, value in counters.items():
+                self._write_statsd(key, '%s|c' % value)
+            for key, value in gauges.items():
+                self._write_statsd(key, '%s|g' % value)
+            for key, stats in timers.items():
+                self._write_statsd(key, '%s|c' % stats.count, '.count')
+                self._write_statsd(key, '%s|g' % stats.sum, '.sum')
+                self._write_statsd(key, '%s|g' % stats.min, '.min')
+                self._write_statsd(key, '%s|g' % stats.max, '.max')
+                for p, value in zip(self.percentiles,
+                                    stats.percentiles(self.percentiles)):
+                    self._write_statsd(key, '%s|g' % value, '.p%s' % p)
+        self.flush()
+
+    def _write_exemplars(self, stamp: int) -> None:
+        bounds = self._aggregator.exemplar_buckets + ['+Inf']
+        for (name, tags), exemplars in sorted(
+                self._aggregator.reset_exemplars().items()):
+            for bound, exemplar in zip(bounds, exemplars.slots):
+                if exemplar is None:
+                    continue
+                self._write_fields(
+                    (name + '_exemplar',
+                     (tags + ',' if tags else '') + 'le=%s' % bound),
+                    'trace_id="%s",value=%s,sampled=%s' % (
+                        exemplar.trace_id, exemplar.value,
+                        'true' if exemplar.sampled else 'false'),
+                    stamp)
+
+    def _write_fields(self, key: SeriesKey, fields: str, stamp: int) -> None:
+        name, tags = key
+        if tags:
+            name = name + ',' + tags
+        self._write(('%s %s %s\n' % (name, fields, stamp)).encode())
+
+    def _write_statsd(self, key: SeriesKey, value: str,
+                      suffix: str = '') -> None:
+        name, tags = key
+        name = name + suffix
+        if tags:
+            name = name + ',' + tags
+        self._write(('%s:%s\n' % (name, value)).encode())
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'lines_sent': self._lines_sent,
+            'bytes_sent': self._bytes_sent,
+            'packets_sent': self._packets_sent,
+            'lines_dropped': dict(self._lines_dropped),
+            'buffer_high_water': self._buffer_high_water,
+            'reconnects': self._reconnects,
+            'send_errors': self._send_errors,
+        }
+
+    def send_stats(self) -> None:
+        if self._stats_handle is not None:
+            self._stats_handle.cancel()
+            self._stats_handle = None
+        if self.closing:
+            return
+        if self.stats_interval:
+            self._stats_handle = self.loop.call_later(self.stats_interval,
+                                                      self.send_stats)
+        values = self.stats()
+        for reason, lines in values.pop('lines_dropped').items():
+            values['lines_dropped_%s' % reason] = lines
+        key = self.series_key('aioapp_metrics')
+        if self.format == 'telegraf-influx':
+            self._write_fields(key, ','.join('%s=%s' % item
+                                             for item in values.items()),
+                               int(time.time() * 1000000000))
+        else:
+            for field, value in values.items():
+                self._write_statsd(key, '%s|g' % value, '.' + field)
+
+    def _write(self, data: bytes) -> None:
+        if self._buf and self._buf_size + len(data) > self.max_packet_size:
+            self.flush()
+        self._buf.append(data)
+        self._buf_size += len(data)
+        if self._buf_size >= self.max_packet_size:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(self.flush_interval,
+                                                      self.flush)
+
+    def flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._buf:
+            return
+        payload = b''.join(self._buf)
+        self._pending.append((payload, len(self._buf)))
+        self._buf.clear()
+        self._buf_size = 0
+        self._pending_size += len(payload)
+        if self._pending_size > self._buffer_high_water:
+            self._buffer_high_water = self._pending_size
+        while self._pending_size > self.max_buffer_size:
+            self._drop('buffer_full')
+        self._drain()
+
+    def _drop(self, reason: str) -> None:
+        payload, lines = self._pending.popleft()
+        self._pending_size -= len(payload)
+        self._lines_dropped[reason] += lines
+
+    def _drain(self) -> None:
+        transport = self.transport
+        if transport is None:
+            return
+        scheme = self.url.scheme
+        while self._pending and not self._paused:
+            payload, lines = self._pending.popleft()
+            self._pending_size -= len(payload)
+            self._lines_sent += lines
+            self._bytes_sent += len(payload)
+            self._packets_sent += 1
+            if scheme == 'udp':
+                transport.sendto(payload)
+            elif scheme == 'unixgram':
+                # transports made of a connected socket still want an address
+                transport.sendto(payload, self.url.path)
+            else:
+                transport.write(payload)
 
     def connection_made(self, transport):
         self.transport = transport
+        self._paused = False
+        self._reconnect_delay = self.reconnect_delay_min
+        self._drain()
 
     def datagram_received(self, data, addr):
         pass
 
+    def data_received(self, data):
+        pass
+
+    def eof_received(self):
+        pass
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        self._drain()
+
     def error_received(self, exc):
+        self._send_errors += 1
         self.tracer.app.log_err(exc)
 
     def connection_lost(self, exc):
         self.tracer.app.log_err(exc)
         self.transport = None
-        if not self.closing:
-            async_call(self.loop, self._connect)
+        self._paused = False
+        self._reconnect()
 
     async def close(self):
         self.closing = True
+        self.flush_aggregates()
+        self.flush()
+        if self._reconnect_handle is not None:
+            self._reconnect_handle.cancel()
+            self._reconnect_handle = None
+        if self._connect_task is not None:
+            self._connect_task.cancel()
+            self._connect_task = None
+        if self._stats_handle is not None:
+            self._stats_handle.cancel()
+            self._stats_handle = None
         if self.transport:
+            self._paused = False
+            self._drain()
             self.transport.close()
+        while self._pending:
+            self._drop('closed')
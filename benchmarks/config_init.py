@@ -0,0 +1,46 @@
+"""
+Config instances built per second for a config of a few hundred
+variables of every builtin type.
+
+    PYTHONPATH=. python benchmarks/config_init.py [variables] [instances]
+"""
+import sys
+import time
+import tempfile
+from aioapp.config import Config
+
+
+def make_config(count):
+    types = [(str, 'value'), (int, '10'), (float, '1.5'), (bool, 'on'),
+             ('dir', tempfile.gettempdir())]
+    variables = {}
+    env = {}
+    for i in range(count):
+        val_type, value = types[i % len(types)]
+        name = 'VAR_%s' % i
+        variables['var_%s' % i] = {
+            'type': val_type,
+            'name': name,
+            'default': value,
+            'descr': 'variable number %s' % i,
+        }
+        if i % 2:
+            env[name] = value
+    return type('BenchConfig', (Config,), {'_vars': variables}), env
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    instances = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    conf_cls, env = make_config(count)
+    conf_cls(env)
+    start = time.perf_counter()
+    for _ in range(instances):
+        conf_cls(env)
+    elapsed = time.perf_counter() - start
+    print('%s variables: %.0f configs/s, %.1f us per config'
+          '' % (count, instances / elapsed, elapsed / instances * 1000000))
+
+
+if __name__ == '__main__':
+    main()
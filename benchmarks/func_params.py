@@ -0,0 +1,46 @@
+"""
+Calls per second of misc.get_func_params for a method and a function,
+compiling the argument tables on every call as before and cached.
+
+    PYTHONPATH=. python benchmarks/func_params.py [calls]
+"""
+import sys
+import time
+from aioapp import misc
+
+
+class Handler:
+    async def handle(self, ctx, user_id, limit=10, offset=0, *,
+                     order='asc', fields=None):
+        pass
+
+
+def func(a, b, c=3, d=4, **kwargs):
+    pass
+
+
+def run(calls, get_params, method, params):
+    start = time.perf_counter()
+    for _ in range(calls):
+        get_params(method, params)
+    return calls / (time.perf_counter() - start)
+
+
+def uncached(method, params):
+    return misc._Binder(method).bind(params)
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print('%-10s %14s %14s' % ('', 'uncached', 'cached'))
+    for name, method, params in (
+            ('method', Handler().handle,
+             {'ctx': None, 'user_id': 1, 'limit': 20, 'order': 'desc'}),
+            ('function', func, {'a': 1, 'b': 2, 'd': 5, 'e': 6})):
+        print('%-10s %12.0f/s %12.0f/s' % (
+            name, run(calls, uncached, method, params),
+            run(calls, misc.get_func_params, method, params)))
+
+
+if __name__ == '__main__':
+    main()
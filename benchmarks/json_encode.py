@@ -0,0 +1,61 @@
+"""
+Encoding throughput of misc.json_encode (str, stdlib compatible output)
+and misc.json_encode_bytes / json_encode_stream with every available
+backend, for a list of records with datetimes, decimals and URLs.
+
+    PYTHONPATH=. python benchmarks/json_encode.py [records]
+"""
+import sys
+import time
+import decimal
+import datetime
+from yarl import URL
+from aioapp import misc
+
+
+def make_payload(records):
+    now = datetime.datetime(2018, 11, 1, 12, 30, 15, 123456)
+    return [{
+        'id': i,
+        'name': 'user %s' % i,
+        'balance': decimal.Decimal('%s.25' % i),
+        'created': now + datetime.timedelta(seconds=i),
+        'birthday': now.date(),
+        'ttl': datetime.timedelta(minutes=5),
+        'avatar': URL('http://example.com/avatars/%s.png' % i),
+        'tags': ['a', 'b', 'c'],
+        'active': i % 2 == 0,
+        'score': i / 7,
+    } for i in range(records)]
+
+
+def run(func, payload, records):
+    start = time.perf_counter()
+    res = func(payload)
+    if not isinstance(res, (str, bytes)):
+        res = b''.join(res)
+    elapsed = time.perf_counter() - start
+    return records / elapsed, len(res)
+
+
+def main():
+    records = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    payload = make_payload(records)
+    print('%-28s %14s %10s' % ('', 'records/s', 'size'))
+    speed, size = run(misc.json_encode, payload, records)
+    print('%-28s %12.0f/s %10s' % ('json_encode', speed, size))
+    for backend in misc.JSON_BACKENDS:
+        try:
+            misc.set_json_backend(backend)
+        except UserWarning:
+            print('%-28s %14s' % (backend, 'not installed'))
+            continue
+        for name, func in (('json_encode_bytes', misc.json_encode_bytes),
+                           ('json_encode_stream', misc.json_encode_stream)):
+            speed, size = run(func, payload, records)
+            print('%-28s %12.0f/s %10s' % ('%s %s' % (name, backend),
+                                           speed, size))
+
+
+if __name__ == '__main__':
+    main()
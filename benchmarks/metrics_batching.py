@@ -0,0 +1,69 @@
+"""
+Compares sending every span metric in its own datagram with MTU-sized
+batches.
+
+    PYTHONPATH=. python benchmarks/metrics_batching.py [spans]
+"""
+import sys
+import time
+import asyncio
+from aioapp.app import Application
+
+
+class Counter:
+    """Counts datagrams passed to the metrics transport"""
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.packets = 0
+        self.lines = 0
+
+    def sendto(self, data):
+        self.packets += 1
+        self.lines += data.count(b'\n')
+        self.transport.sendto(data)
+
+
+async def run(loop, spans, max_packet_size):
+    transport, _ = await loop.create_datagram_endpoint(
+        asyncio.DatagramProtocol, local_addr=('127.0.0.1', 0))
+    port = transport.get_extra_info('sockname')[1]
+    app = Application(loop=loop)
+    app.setup_logging(metrics_driver='telegraf-influx',
+                      metrics_addr='udp://127.0.0.1:%s' % port,
+                      metrics_name='bench_',
+                      metrics_max_packet_size=max_packet_size)
+    await asyncio.sleep(0.01)
+    metrics = app.tracer.metrics
+    counter = metrics.transport = Counter(metrics.transport)
+
+    start = time.perf_counter()
+    for i in range(spans):
+        with app.tracer.new_trace() as span:
+            span.name('request')
+            span.tag('method', 'GET', True)
+            span.tag('status', '200', True)
+    metrics.flush()
+    elapsed = time.perf_counter() - start
+
+    metrics.transport = counter.transport
+    await app.tracer.close()
+    transport.close()
+    return elapsed, counter.packets, counter.lines
+
+
+def main():
+    spans = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    loop = asyncio.get_event_loop()
+    print('%-12s %10s %10s %12s %12s' % ('mode', 'packets', 'lines',
+                                         'packets/s', 'spans/s'))
+    for mode, size in (('unbatched', 0), ('batched', 1432)):
+        elapsed, packets, lines = loop.run_until_complete(
+            run(loop, spans, size))
+        print('%-12s %10d %10d %12.0f %12.0f' % (
+            mode, packets, lines, packets / elapsed, spans / elapsed))
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Lines per second encoded by InfluxMetrics for spans with realistic tag
+sets, with and without the series key cache.
+
+    PYTHONPATH=. python benchmarks/metrics_series_keys.py [lines]
+"""
+import sys
+import time
+import asyncio
+from yarl import URL
+from aioapp.app import Application
+from aioapp.tracer import InfluxMetrics
+
+
+class NullTransport:
+    def sendto(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+def make_spans(app):
+    spans = []
+    for route in ('/api/v1/users', '/api/v1/orders', '/health'):
+        for method in ('GET', 'POST'):
+            for status in ('200', '404', '500'):
+                span = app.tracer.new_trace()
+                span.name('http_in')
+                span.metrics_tag('route', route)
+                span.metrics_tag('method', method)
+                span.metrics_tag('status', status)
+                span.metrics_tag('host', 'worker-1.example.com')
+                span.start(ts=1000).finish(ts=1000.25)
+                spans.append(span)
+    return spans
+
+
+def run(loop, lines, driver, cache_size):
+    app = Application(loop=loop)
+    metrics = InfluxMetrics(app.tracer, URL('udp://127.0.0.1:8125'),
+                            'bench_', driver, loop,
+                            series_cache_size=cache_size)
+    metrics.transport = NullTransport()
+    spans = make_spans(app)
+    count = len(spans)
+    start = time.perf_counter()
+    for i in range(lines):
+        metrics.send(spans[i % count])
+    elapsed = time.perf_counter() - start
+    loop.run_until_complete(metrics.close())
+    return lines / elapsed
+
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    loop = asyncio.get_event_loop()
+    print('%-16s %14s %14s' % ('driver', 'no cache', 'cache'))
+    for driver in ('telegraf-influx', 'statsd-influx'):
+        print('%-16s %12.0f/s %12.0f/s' % (driver,
+                                           run(loop, lines, driver, 0),
+                                           run(loop, lines, driver, 1024)))
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Cost of scheduling and cancelling many delayed calls with loop.call_later
+and with the timer wheel scheduler, and of firing them.
+
+    PYTHONPATH=. python benchmarks/scheduler.py [timers]
+"""
+import sys
+import time
+import random
+import asyncio
+from aioapp.scheduler import Scheduler
+
+
+def noop():
+    pass
+
+
+def run(loop, timers, call_later):
+    delays = [random.uniform(0.1, 60) for _ in range(timers)]
+    start = time.perf_counter()
+    handles = [call_later(delay, noop) for delay in delays]
+    scheduled = time.perf_counter() - start
+    start = time.perf_counter()
+    for handle in handles:
+        handle.cancel()
+    cancelled = time.perf_counter() - start
+
+    fired = []
+    start = time.perf_counter()
+    for i in range(timers):
+        call_later(random.uniform(0, 0.5), fired.append, i)
+    while len(fired) < timers:
+        loop.run_until_complete(asyncio.sleep(0.01))
+    total = time.perf_counter() - start
+    return scheduled, cancelled, total
+
+
+def main():
+    timers = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    loop = asyncio.get_event_loop()
+    scheduler = Scheduler(loop)
+    print('%-12s %12s %12s %16s' % ('', 'schedule', 'cancel',
+                                    'fire in 0.5s'))
+    for name, call_later in (('call_later', loop.call_later),
+                             ('scheduler', scheduler.call_later)):
+        scheduled, cancelled, total = run(loop, timers, call_later)
+        print('%-12s %10.0fms %10.0fms %14.0fms' % (
+            name, scheduled * 1000, cancelled * 1000, total * 1000))
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""
+Tokens per second made by the former per-character SystemRandom choice,
+misc.rndstr and TokenGenerator.tokens in batches.
+
+    PYTHONPATH=. python benchmarks/tokens.py [tokens] [size]
+"""
+import sys
+import time
+import string
+from random import SystemRandom
+from aioapp import misc
+
+CHARS = string.ascii_uppercase + string.digits
+
+
+def choice_rndstr(size=6, chars=CHARS):
+    cryptogen = SystemRandom()
+    return ''.join(cryptogen.choice(chars) for _ in range(size))
+
+
+def run(func, tokens):
+    start = time.perf_counter()
+    func()
+    return tokens / (time.perf_counter() - start)
+
+
+def main():
+    tokens = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    gen = misc.TokenGenerator(CHARS)
+    for name, func in (
+            ('SystemRandom.choice', lambda: [choice_rndstr(size)
+                                             for _ in range(tokens)]),
+            ('rndstr', lambda: [misc.rndstr(size) for _ in range(tokens)]),
+            ('tokens(1000)', lambda: [gen.tokens(1000, size)
+                                      for _ in range(tokens // 1000)])):
+        print('%-20s %12.0f tokens/s' % (name, run(func, tokens)))
+
+
+if __name__ == '__main__':
+    main()
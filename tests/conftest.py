@@ -81,14 +81,16 @@ def metrics_server(loop):
             self.transport = transport
 
         def datagram_received(self, data, addr):
-            d = data.decode().split(' ')
-            n = d[0].split(',')
-            requests.append({
-                'name': n[0],
-                'tags': {t.split('=')[0]: t.split('=')[1] for t in n[1:]},
-                'duration': d[1],
-                'time': d[2]
-            })
+            for line in data.decode().splitlines():
+                d = line.split(' ')
+                n = d[0].split(',')
+                requests.append({
+                    'name': n[0],
+                    'tags': {t.split('=')[0]: t.split('=')[1]
+                             for t in n[1:]},
+                    'duration': d[1],
+                    'time': d[2]
+                })
             logging.info('TELEGRAF received %s from %s', data, addr)
             pass
 
@@ -108,6 +110,21 @@ def metrics_server(loop):
     transport.close()
 
 
+@pytest.fixture
+async def udp_receiver(loop):
+    """Raw datagrams received on a free local UDP port"""
+    packets = []
+
+    class Receiver(asyncio.DatagramProtocol):
+        def datagram_received(self, data, addr):
+            packets.append(data)
+
+    transport, _ = await loop.create_datagram_endpoint(
+        Receiver, local_addr=('127.0.0.1', 0))
+    yield transport.get_extra_info('sockname')[1], packets
+    transport.close()
+
+
 @pytest.fixture(params=["with_tracer", "without_tracer"])
 async def app(request, tracer_server, metrics_server, loop):
     app = Application(loop=loop)
@@ -1,4 +1,5 @@
 import gc
+import time
 import pytest
 import asyncio
 from aioapp.app import Application, Component
@@ -109,3 +110,40 @@ async def test_abc_component():
         await cmp.start()
     with pytest.raises(NotImplementedError):
         await cmp.stop()
+
+
+async def test_loop_monitor(app: Application, loop):
+    spans = []
+    app.tracer.on_span_finish = spans.append
+    app.setup_loop_monitor(0.05)
+    app.tracer.setup_trace_store()
+    try:
+        def blocking_callback():
+            time.sleep(0.06)
+
+        async def blocking_task(ctx):
+            await asyncio.sleep(0)
+            time.sleep(0.06)
+
+        loop.call_soon(blocking_callback)
+        await asyncio.sleep(0.1)
+        with app.tracer.new_trace() as ctx:
+            ctx.name('parent')
+            await blocking_task(ctx)
+            await asyncio.ensure_future(blocking_task(ctx), loop=loop)
+    finally:
+        await app.run_shutdown()
+    assert 'call_soon' not in vars(loop)
+
+    names = [(span._name, span._tags.get('lc')) for span in spans]
+    assert ('loop:callback',
+            'test_loop_monitor.<locals>.blocking_callback') in names
+    task_spans = [span for span in spans if span._name == 'loop:task']
+    assert task_spans
+    for span in task_spans:
+        assert span.trace_id == ctx.trace_id
+        assert span.parent_id == ctx.id
+        assert span in ctx._children
+    # only kept in the store with the trace they belong to
+    stored = app.tracer.slowest_traces(100)
+    assert not [span for span in stored if span._name == 'loop:task']
@@ -0,0 +1,155 @@
+import asyncio
+import aiohttp
+from aioapp.app import Application, Component
+from aioapp.error import HttpError
+from aioapp.httpserver import HttpServer, Response
+from aioapp.tracer import (HTTP_STATUS_CODE, HTTP_METHOD, HTTP_PATH,
+                           HTTP_REQUEST_SIZE)
+from .conftest import get_free_port
+
+
+class Broken(Component):
+    healthy = True
+
+    async def prepare(self):
+        pass
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def health(self, ctx):
+        if not self.healthy:
+            raise Exception('broken')
+
+
+async def request(port, data):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(data)
+    try:
+        return await asyncio.wait_for(reader.read(), 1)
+    finally:
+        writer.close()
+
+
+async def test_http_server(loop):
+    port = get_free_port()
+    app = Application(loop=loop)
+    spans = []
+    app.tracer.on_span_finish = spans.append
+    server = HttpServer('127.0.0.1', port, max_head_size=1024,
+                        max_body_size=100)
+
+    async def echo(ctx, req):
+        return Response.json({'body': req.body.decode(), 'query': req.query,
+                              'trace_id': ctx.trace_id})
+
+    async def fail(ctx, req):
+        raise ZeroDivisionError()
+
+    async def forbidden(ctx, req):
+        raise HttpError(403, 'no')
+
+    async def invalid(ctx, req):
+        return {'not': 'a response'}
+
+    server.add_route('POST', '/echo', echo)
+    server.add_route('GET', '/echo', echo)
+    server.add_route('GET', '/fail', fail)
+    server.add_route('GET', '/forbidden', forbidden)
+    server.add_route('GET', '/invalid', invalid)
+    app.add('http', server)
+    app.add('broken', Broken())
+    await app.run_prepare()
+    url = 'http://127.0.0.1:%s' % port
+    try:
+        async with aiohttp.ClientSession(loop=loop) as session:
+            async with session.post(url + '/echo?a=1', data=b'hello',
+                                    headers={'X-B3-TraceId': '1' * 32,
+                                             'X-B3-SpanId': '2' * 16}
+                                    ) as resp:
+                assert resp.status == 200
+                assert resp.headers['Connection'] == 'keep-alive'
+                assert await resp.json() == {'body': 'hello', 'query': 'a=1',
+                                             'trace_id': '1' * 32}
+            # the connection is reused
+            async with session.get(url + '/echo') as resp:
+                assert resp.status == 200
+            assert len(session.connector._conns) == 1
+            for path, status in (('/fail', 500), ('/forbidden', 403),
+                                 ('/unknown', 404)):
+                async with session.get(url + path) as resp:
+                    assert resp.status == status
+            async with session.delete(url + '/echo') as resp:
+                assert resp.status == 405
+                assert resp.headers['Allow'] == 'GET, HEAD, POST'
+            async with session.get(url + '/health') as resp:
+                assert resp.status == 200
+                assert await resp.json() == {'http': None, 'broken': None}
+            app.broken.healthy = False
+            async with session.get(url + '/health') as resp:
+                assert resp.status == 503
+                assert (await resp.json())['broken'] == 'broken'
+            async with session.get(url + '/metrics') as resp:
+                assert resp.status == 200
+                text = await resp.text()
+                assert ('http_in_duration_seconds_count{http_method="POST",'
+                        'http_status_code="200",route="/echo"} 1') in text
+
+        # pipelined requests are answered in order
+        data = await request(port, b'GET /echo?1 HTTP/1.1\r\n\r\n'
+                                   b'POST /echo?2 HTTP/1.1\r\n'
+                                   b'Transfer-Encoding: chunked\r\n\r\n'
+                                   b'3\r\nabc\r\n2\r\nde\r\n0\r\n\r\n'
+                                   b'HEAD /echo?3 HTTP/1.1\r\n'
+                                   b'Connection: close\r\n\r\n')
+        responses = data.split(b'HTTP/1.1 ')[1:]
+        assert len(responses) == 3
+        assert b'"query":"1"' in responses[0]
+        assert b'"body":"abcde","query":"2"' in responses[1]
+        assert responses[2].startswith(b'200 OK\r\n')
+        assert b'Connection: close' in responses[2]
+        assert responses[2].endswith(b'\r\n\r\n')
+
+        data = await request(port, b'GET /echo HTTP/1.1\r\nX: ' +
+                             b'x' * 2000 + b'\r\n\r\n')
+        assert data.startswith(b'HTTP/1.1 431 ')
+        data = await request(port, b'POST /echo HTTP/1.1\r\n'
+                                   b'Content-Length: 101\r\n\r\n')
+        assert data.startswith(b'HTTP/1.1 413 ')
+        # oversized and truncated chunk size lines
+        data = await request(port, b'POST /echo HTTP/1.1\r\n'
+                                   b'Transfer-Encoding: chunked\r\n\r\n' +
+                             b'1' * 2000 + b'\r\n')
+        assert data.startswith(b'HTTP/1.1 413 ')
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'POST /echo HTTP/1.1\r\n'
+                     b'Transfer-Encoding: chunked\r\n\r\n5\r\nab')
+        writer.write_eof()
+        data = await asyncio.wait_for(reader.read(), 1)
+        writer.close()
+        assert data.startswith(b'HTTP/1.1 400 ')
+        data = await request(port, b'GET /invalid HTTP/1.1\r\n'
+                                   b'Connection: close\r\n\r\n')
+        assert data.startswith(b'HTTP/1.1 500 ')
+        data = await request(port, b'GET /echo HTTP/2.0\r\n\r\n')
+        assert data.startswith(b'HTTP/1.1 505 ')
+        data = await request(port, b'GET /echo HTTP/1.0\r\n\r\n')
+        assert data.startswith(b'HTTP/1.1 200 OK')
+        assert b'Connection: close' in data
+    finally:
+        await app.run_shutdown()
+
+    traced = [span for span in spans if not span._skip]
+    assert all(span._name == 'http_in' for span in traced)
+    first = traced[0]
+    assert first.trace_id == '1' * 32
+    assert first.parent_id == '2' * 16
+    assert first._tags[HTTP_METHOD] == 'POST'
+    assert first._tags[HTTP_PATH] == '/echo'
+    assert first._tags[HTTP_REQUEST_SIZE] == '5'
+    statuses = [span._tags[HTTP_STATUS_CODE] for span in traced]
+    assert statuses[:6] == ['200', '200', '500', '403', '404', '405']
+    assert traced[2]._tags['error'] == 'true'
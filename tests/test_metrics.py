@@ -0,0 +1,176 @@
+import asyncio
+import pytest
+from aioapp.app import Application
+from aioapp.metrics import (Aggregator, TimerStats, Registry,
+                            CardinalityLimiter, Exemplars)
+
+
+def test_timer_stats():
+    stats = TimerStats(reservoir_size=10)
+    assert stats.percentiles([50]) == [0]
+    for value in [5, 3, 8, 1, 9]:
+        stats.add(value)
+    assert (stats.count, stats.sum, stats.min, stats.max) == (5, 26, 1, 9)
+    assert stats.percentiles([0, 50, 100]) == [1, 5, 9]
+
+    for value in range(1000):
+        stats.add(value)
+    assert stats.count == 1005
+    assert len(stats._reservoir) == 10
+    assert stats.max == 999
+
+
+def test_aggregator():
+    agg = Aggregator()
+    key = ('name', 'tag=1')
+    agg.count(key)
+    agg.count(key, 2)
+    agg.gauge(key, 5)
+    agg.gauge(key, 7)
+    agg.timer(key, 10)
+    agg.timer(key, 20)
+
+    counters, gauges, timers = agg.reset()
+    assert counters == {key: 3}
+    assert gauges == {key: 7}
+    assert timers[key].count == 2
+    assert timers[key].sum == 30
+
+    counters, gauges, timers = agg.reset()
+    assert counters == {}
+    assert gauges == {key: 7}
+    assert timers == {}
+
+
+@pytest.mark.parametrize('driver', ['telegraf-influx', 'statsd-influx'])
+async def test_instruments(loop, udp_receiver, driver):
+    port, packets = udp_receiver
+    app = Application(loop=loop)
+    counter = app.tracer.counter('hits', {'cache': 'main'})
+    counter.inc()  # metrics are not set up yet
+
+    app.setup_logging(metrics_driver=driver,
+                      metrics_addr='udp://127.0.0.1:%s' % port,
+                      metrics_name='test_')
+    await asyncio.sleep(0.01)
+    counter.inc(2)
+    app.tracer.gauge('queue').set(-5)
+    app.tracer.histogram('size').observe(10)
+    timer = app.tracer.timer('op')
+    timer.record(0.5)
+    with timer.time():
+        pass
+    await app.tracer.close()
+    await asyncio.sleep(0.01)
+
+    lines = [line for packet in packets
+             for line in packet.decode().splitlines()]
+    if driver == 'telegraf-influx':
+        lines = [line.rsplit(' ', 1)[0] for line in lines]
+        assert lines[:4] == ['test_hits,cache=main count=2',
+                             'test_queue value=-5',
+                             'test_size value=10',
+                             'test_op duration=500000']
+    else:
+        assert lines[:5] == ['test_hits,cache=main:2|c',
+                             'test_queue:0|g',
+                             'test_queue:-5|g',
+                             'test_size:10|h',
+                             'test_op:500000|ms']
+    assert len(lines) == (5 if driver == 'telegraf-influx' else 6)
+
+
+async def test_instruments_aggregate(loop, udp_receiver):
+    port, packets = udp_receiver
+    app = Application(loop=loop)
+    app.setup_logging(metrics_driver='telegraf-influx',
+                      metrics_addr='udp://127.0.0.1:%s' % port,
+                      metrics_aggregate=True)
+    await asyncio.sleep(0.01)
+    counter = app.tracer.counter('hits')
+    gauge = app.tracer.gauge('queue')
+    histogram = app.tracer.histogram('size')
+    for i in range(1, 11):
+        counter.inc()
+        gauge.set(i)
+        histogram.observe(i)
+    await app.tracer.close()
+    await asyncio.sleep(0.01)
+
+    lines = [line.rsplit(' ', 1)[0] for packet in packets
+             for line in packet.decode().splitlines()]
+    assert lines == ['hits count=10', 'queue value=10',
+                     'size count=10,sum=55,min=1,max=10,p50=5,p90=9,p99=10']
+
+
+def test_registry():
+    registry = Registry(buckets=[1, 10])
+    assert registry.render() == ''
+    key = Registry.key('size', {'b': '2', 'a': '1'})
+    assert key == ('size', (('a', '1'), ('b', '2')))
+    for value in (0.5, 1, 5, 50):
+        registry.observe(key, value)
+    registry.count(Registry.key('requests_total'), 2)
+    assert registry.render() == '''\
+# TYPE requests_total counter
+requests_total 2
+# TYPE size histogram
+size_bucket{a="1",b="2",le="1.0"} 2
+size_bucket{a="1",b="2",le="10.0"} 3
+size_bucket{a="1",b="2",le="+Inf"} 4
+size_sum{a="1",b="2"} 56.5
+size_count{a="1",b="2"} 4
+'''
+
+
+def test_registry_exemplars():
+    registry = Registry(buckets=[1, 10])
+    key = Registry.key('size')
+    registry.observe(key, 0.5, 'a', sampled=False)
+    registry.observe(key, 0.2, 'b', sampled=True)
+    registry.observe(key, 0.7, 'c', sampled=False)
+    registry.observe(key, 5, 'd', sampled=False)
+    registry.observe(key, 50)
+    registry.count(Registry.key('requests_total'), 2)
+    assert 'trace_id' not in registry.render()
+    lines = registry.render(openmetrics=True).splitlines()
+    assert lines[:2] == ['# TYPE requests counter', 'requests_total 2']
+    # sampled trace is preferred over a slower unsampled one
+    assert lines[3].startswith('size_bucket{le="1.0"} 3 # {trace_id="b"} '
+                               '0.2 ')
+    assert lines[4].startswith('size_bucket{le="10.0"} 4 # {trace_id="d"} '
+                               '5 ')
+    assert lines[5] == 'size_bucket{le="+Inf"} 5'
+    assert lines[-1] == '# EOF'
+
+    exemplars = Exemplars(1)
+    exemplars.offer(0, 2, 'a', False)
+    exemplars.offer(0, 1, 'b', False)
+    assert exemplars.slots[0].trace_id == 'a'
+    exemplars.slots[0].stamp -= Exemplars.max_age + 1
+    exemplars.offer(0, 1, 'b', False)
+    assert exemplars.slots[0].trace_id == 'b'
+
+
+def test_cardinality_limiter():
+    overflows = []
+    limiter = CardinalityLimiter(max_values=2, limits={'wide': 3},
+                                 max_names=2,
+                                 on_overflow=lambda *a: overflows.append(a))
+    tags = {'user': '1', 'method': 'GET'}
+    assert limiter.limit('req', tags) is tags
+    assert limiter.limit('req', {'user': '2', 'method': 'GET'}) == {
+        'user': '2', 'method': 'GET'}
+    assert limiter.limit('req', {'user': '3', 'method': 'GET'}) == {
+        'user': '__other__', 'method': 'GET'}
+    assert limiter.limit('req', {'user': '1', 'method': 'GET'}) == tags
+    assert limiter.limit('req', {'user': '4', 'method': 'GET'}) == {
+        'user': '__other__', 'method': 'GET'}
+    for user in '123':
+        assert limiter.limit('wide', {'user': user}) == {'user': user}
+    assert limiter.limit('new', {'user': '1'}) == {'user': '__other__'}
+
+    assert overflows == [('req', 'user'), ('new', 'user')]
+    assert limiter.overflow() == {'req': ['user'], 'new': ['user']}
+    assert sum(len(values) for seen in limiter._seen.values()
+               for values in seen.values()) == 6
@@ -0,0 +1,157 @@
+import asyncio
+import pytest
+from aioapp.app import Application
+from aioapp.error import PrepareError, PoolTimeoutError, PoolClosedError
+from aioapp.metrics import Registry
+from aioapp.pool import PoolComponent
+
+
+class Pool(PoolComponent):
+
+    def __init__(self, *args, fail=False, fail_after=None, delay=0.001,
+                 **kwargs):
+        super().__init__('test', *args, **kwargs)
+        self.fail = fail
+        self.delay = delay
+        self.fail_after = fail_after
+        self.created = 0
+        self.closed = []
+        self.broken = set()
+
+    async def create_conn(self, ctx):
+        await asyncio.sleep(self.delay)
+        if self.fail or self.created == self.fail_after:
+            raise ConnectionRefusedError()
+        self.created += 1
+        return self.created
+
+    async def close_conn(self, conn):
+        self.closed.append(conn)
+
+    async def check_conn(self, ctx, conn):
+        if conn in self.broken:
+            raise ConnectionResetError()
+
+
+async def test_pool(loop):
+    app = Application(loop=loop)
+    app.tracer.setup_registry()
+    spans = []
+    app.tracer.on_span_finish = spans.append
+    pool = Pool(min_size=2, max_size=3, acquire_timeout=0.05)
+    app.add('pool', pool)
+    await app.run_prepare()
+    assert (pool.size, pool.idle, pool.in_use) == (2, 2, 0)
+
+    ctx = app.tracer.new_trace()
+    async with pool.acquire(ctx) as conn1:
+        conn2 = await pool.acquire_conn(ctx)
+        conn3 = await pool.acquire_conn(ctx)
+        # the warmup connections are opened concurrently
+        assert {conn1, conn2} == {1, 2}
+        assert conn3 == 3
+        assert (pool.size, pool.idle, pool.in_use) == (3, 0, 3)
+
+        with pytest.raises(PoolTimeoutError):
+            await pool.acquire_conn(ctx)
+
+        waiter = asyncio.ensure_future(pool.acquire_conn(ctx), loop=loop)
+        await asyncio.sleep(0.01)
+        assert pool.waiting == 1
+        pool.release(conn2)
+        assert await waiter == conn2
+
+        # a broken connection is replaced for the waiter
+        waiter = asyncio.ensure_future(pool.acquire_conn(ctx), loop=loop)
+        await asyncio.sleep(0.01)
+        pool.release(conn3, discard=True)
+        assert await waiter == 4
+        assert pool.closed == [3]
+        pool.release(conn2)
+        pool.release(4)
+
+    with pytest.raises(ConnectionResetError):
+        async with pool.acquire(ctx) as conn:
+            raise ConnectionResetError()
+    await asyncio.sleep(0.01)
+    assert pool.closed == [3, conn]
+    assert pool.size == 2
+
+    names = [span._name for span in spans]
+    assert names.count('test_acquire') == 7
+    assert names.count('test_connect') == 4
+    pool._report()
+    gauges = app.tracer.registry.gauges
+    assert gauges[Registry.key('pool_size', {'pool': 'test'})] == 2
+    assert gauges[Registry.key('pool_utilization', {'pool': 'test'})] == 0
+
+    pool.broken.add(pool._idle[-1][0])
+    health = await app.health()
+    assert isinstance(health['pool'], ConnectionResetError)
+    assert (await app.health())['pool'] is None
+
+    conn = await pool.acquire_conn(ctx)
+    await app.run_shutdown()
+    with pytest.raises(PoolClosedError):
+        await pool.acquire_conn(ctx)
+    pool.release(conn)
+    # released twice
+    pool.release(conn)
+    await asyncio.sleep(0.01)
+    assert pool.size == 0
+    assert pool.closed.count(conn) == 1
+    assert sorted(pool.closed) == list(range(1, pool.created + 1))
+
+
+async def test_pool_idle(loop):
+    app = Application(loop=loop)
+    pool = Pool(min_size=1, max_size=3, max_idle_time=0.05,
+                stats_interval=0.02)
+    app.add('pool', pool)
+    await app.run_prepare()
+    ctx = app.tracer.new_trace()
+    conns = [await pool.acquire_conn(ctx) for _ in range(3)]
+    for conn in conns:
+        pool.release(conn)
+    assert pool.idle == 3
+    await asyncio.sleep(0.15)
+    assert (pool.size, pool.idle) == (1, 1)
+    assert len(pool.closed) == 2
+    await app.run_shutdown()
+
+
+async def test_pool_prepare_error(loop):
+    app = Application(loop=loop)
+    pool = Pool(fail=True)
+    app.add('pool', pool)
+    with pytest.raises(PrepareError):
+        await app.run_prepare()
+    assert pool.size == 0
+
+    # connections opened before the failure are closed
+    app = Application(loop=loop)
+    pool = Pool(min_size=3, fail_after=2)
+    app.add('pool', pool)
+    with pytest.raises(PrepareError):
+        await app.run_prepare()
+    assert sorted(pool.closed) == [1, 2]
+    assert (pool.size, pool.idle) == (0, 0)
+
+
+async def test_pool_connect_timeout(loop):
+    app = Application(loop=loop)
+    pool = Pool(min_size=0, acquire_timeout=0.01, delay=1)
+    app.add('pool', pool)
+    await app.run_prepare()
+    with pytest.raises(PoolTimeoutError):
+        await pool.acquire_conn(app.tracer.new_trace())
+    await asyncio.sleep(0)
+    assert pool.size == 0
+    await app.run_shutdown()
+
+
+async def test_pool_not_added(loop):
+    pool = Pool()
+    pool.loop = loop
+    with pytest.raises(PrepareError):
+        await pool.prepare()
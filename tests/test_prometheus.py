@@ -0,0 +1,93 @@
+import aiohttp
+from aioapp.app import Application
+from aioapp.prometheus import PrometheusExporter
+from .conftest import get_free_port
+
+
+async def test_prometheus_exporter(loop):
+    port = get_free_port()
+    app = Application(loop=loop)
+    app.add('prometheus', PrometheusExporter('127.0.0.1', port,
+                                             prefix='test_'))
+    await app.run_prepare()
+    try:
+        await app.prometheus.health(None)
+        for duration in (0.001, 0.2, 20):
+            span = app.tracer.new_trace()
+            span.name('http_in').metrics_tag('path', '/a "b"')
+            span.start(ts=100).finish(ts=100 + duration)
+        app.tracer.counter('hits', {'cache': 'main'}).inc(3)
+        app.tracer.gauge('queue').set(7)
+        app.tracer.timer('op').record(0.01)
+
+        url = 'http://127.0.0.1:%s' % port
+        async with aiohttp.ClientSession(loop=loop) as session:
+            async with session.get(url + '/metrics') as resp:
+                assert resp.status == 200
+                assert resp.headers['Content-Type'].startswith(
+                    'text/plain; version=0.0.4')
+                text = await resp.text()
+            async with session.get(url + '/metrics', headers={
+                    'Accept': 'application/openmetrics-text; '
+                              'version=1.0.0'}) as resp:
+                assert resp.headers['Content-Type'].startswith(
+                    'application/openmetrics-text; version=1.0.0')
+                om_lines = (await resp.text()).splitlines()
+            async with session.get(url + '/other') as resp:
+                assert resp.status == 404
+    finally:
+        await app.run_shutdown()
+
+    lines = text.splitlines()
+    assert lines[:4] == ['# TYPE test_hits_total counter',
+                         'test_hits_total{cache="main"} 3',
+                         '# TYPE test_queue gauge',
+                         'test_queue 7']
+    assert '# TYPE test_http_in_duration_seconds histogram' in lines
+    assert ('test_http_in_duration_seconds_bucket'
+            '{path="/a \\"b\\"",le="0.005"} 1') in lines
+    assert ('test_http_in_duration_seconds_bucket'
+            '{path="/a \\"b\\"",le="0.25"} 2') in lines
+    assert ('test_http_in_duration_seconds_bucket'
+            '{path="/a \\"b\\"",le="+Inf"} 3') in lines
+    assert 'test_http_in_duration_seconds_count{path="/a \\"b\\""} 3' \
+        in lines
+    assert 'test_op_count 1' in lines
+
+    assert om_lines[0] == '# TYPE test_hits counter'
+    assert om_lines[-1] == '# EOF'
+    assert ('test_http_in_duration_seconds_bucket'
+            '{path="/a \\"b\\"",le="+Inf"} 3 # {trace_id="%s"} 20.0 '
+            '' % span.trace_id) in [line[:line.rindex(' ') + 1]
+                                    for line in om_lines]
+
+
+async def test_prometheus_exporter_cardinality(loop):
+    port = get_free_port()
+    app = Application(loop=loop)
+    app.add('prometheus', PrometheusExporter('127.0.0.1', port,
+                                             max_tag_values=2))
+    await app.run_prepare()
+    try:
+        for user in range(5):
+            span = app.tracer.new_trace()
+            span.name('http_in').metrics_tag('user', user)
+            span.start(ts=100).finish(ts=100.001)
+            app.tracer.counter('hits', {'user': str(user)}).inc()
+        async with aiohttp.ClientSession(loop=loop) as session:
+            url = 'http://127.0.0.1:%s/metrics' % port
+            async with session.get(url) as resp:
+                lines = (await resp.text()).splitlines()
+    finally:
+        await app.run_shutdown()
+
+    assert [line for line in lines if line.startswith('hits_total')] == [
+        'hits_total{user="0"} 1', 'hits_total{user="1"} 1',
+        'hits_total{user="__other__"} 3']
+    assert [line for line in lines
+            if line.startswith('http_in_duration_seconds_count')] == [
+        'http_in_duration_seconds_count{user="0"} 1',
+        'http_in_duration_seconds_count{user="1"} 1',
+        'http_in_duration_seconds_count{user="__other__"} 3']
+    assert app.tracer.registry.limiter.overflow() == {
+        'hits': ['user'], 'http_in_duration_seconds': ['user']}
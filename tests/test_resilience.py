@@ -0,0 +1,233 @@
+import asyncio
+import pytest
+from aioapp.app import Application
+from aioapp.error import (BulkheadFullError, BulkheadTimeoutError,
+                          CircuitOpenError)
+from aioapp.metrics import Registry
+from aioapp.resilience import (Bulkhead, CircuitBreaker, Retry, RetryBudget,
+                               CLOSED, HALF_OPEN, OPEN)
+
+
+async def test_bulkhead(loop):
+    app = Application(loop=loop)
+    app.tracer.setup_registry()
+    spans = []
+    app.tracer.on_span_finish = spans.append
+    bulkhead = Bulkhead(loop, app.tracer, 'db', max_concurrent=2,
+                        max_queued=2, queue_timeout=0.05, stats_interval=0)
+    ctx = app.tracer.new_trace()
+    order = []
+
+    async def work(name, delay):
+        order.append(name)
+        await asyncio.sleep(delay)
+
+    first = asyncio.ensure_future(bulkhead.call(ctx, work, 1, 0.02),
+                                  loop=loop)
+    second = asyncio.ensure_future(bulkhead.call(ctx, work, 2, 0.02),
+                                   loop=loop)
+    queued = [asyncio.ensure_future(bulkhead.call(ctx, work, name, 0),
+                                    loop=loop) for name in (3, 4)]
+    await asyncio.sleep(0)
+    assert (bulkhead.in_flight, bulkhead.queued) == (2, 2)
+    gauges = app.tracer.registry.gauges
+    assert gauges[Registry.key('bulkhead_queued', {'bulkhead': 'db'})] == 2
+    with pytest.raises(BulkheadFullError):
+        await bulkhead.enter(ctx)
+
+    await asyncio.gather(first, second, *queued, loop=loop)
+    assert order == [1, 2, 3, 4]
+    assert (bulkhead.in_flight, bulkhead.queued) == (0, 0)
+    assert gauges[Registry.key('bulkhead_in_flight', {'bulkhead': 'db'})] == 0
+    queue_spans = [span for span in spans if span._name == 'db_queue']
+    assert len(queue_spans) == 2
+    assert all(span.parent is ctx for span in queue_spans)
+    assert queue_spans[0]._tags['bulkhead.queued'] == '0'
+
+    await bulkhead.enter(ctx)
+    async with bulkhead.acquire(ctx):
+        with pytest.raises(BulkheadTimeoutError):
+            await bulkhead.enter(ctx)
+        waiter = asyncio.ensure_future(bulkhead.enter(ctx), loop=loop)
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        assert bulkhead.queued == 0
+    bulkhead.release()
+    assert bulkhead.in_flight == 0
+    counters = app.tracer.registry.counters
+    assert counters[Registry.key('bulkhead_rejected', {
+        'bulkhead': 'db', 'reason': 'full'})] == 1
+    assert counters[Registry.key('bulkhead_rejected', {
+        'bulkhead': 'db', 'reason': 'timeout'})] == 1
+    assert spans[-1]._tags['error'] == 'true'
+
+
+async def test_circuit_breaker(loop):
+    app = Application(loop=loop)
+    app.tracer.setup_registry()
+    breaker = CircuitBreaker(loop, name='api', window=1., min_calls=4,
+                             failure_ratio=0.5, slow_call_duration=0.02,
+                             open_timeout=0.05, half_open_calls=2)
+    app.add('api_breaker', breaker)
+    ctx = app.tracer.new_trace()
+
+    async def ok(delay=0):
+        await asyncio.sleep(delay)
+        return 'ok'
+
+    async def fail():
+        raise ConnectionError()
+
+    assert await breaker.call(ctx, ok) == 'ok'
+    assert await breaker.call(ctx, ok) == 'ok'
+    with pytest.raises(ConnectionError):
+        await breaker.call(ctx, fail)
+    assert breaker.state == CLOSED
+    with pytest.raises(ConnectionError):
+        async with breaker.guard(ctx):
+            raise ConnectionError()
+    assert breaker.state == OPEN
+    assert ctx._annotations[-1][0] == 'api circuit open'
+    with pytest.raises(CircuitOpenError):
+        await breaker.call(ctx, ok)
+    health = await app.health()
+    assert isinstance(health['api_breaker'], CircuitOpenError)
+    gauge_key = Registry.key('circuit_breaker_state', {'breaker': 'api'})
+    assert app.tracer.registry.gauges[gauge_key] == 2
+
+    # two probes, the third call is rejected while they run
+    await asyncio.sleep(0.06)
+    health = await app.health()
+    assert str(health['api_breaker']) == 'api circuit is half_open'
+    probes = [asyncio.ensure_future(breaker.call(ctx, ok, 0.001), loop=loop)
+              for _ in range(2)]
+    await asyncio.sleep(0)
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        await breaker.call(ctx, ok)
+    assert await asyncio.gather(*probes, loop=loop) == ['ok', 'ok']
+    assert breaker.state == CLOSED
+    assert (await app.health())['api_breaker'] is None
+    assert app.tracer.registry.gauges[gauge_key] == 0
+
+    # slow calls open it as well, a slow probe opens it again
+    for _ in range(4):
+        await breaker.call(ctx, ok, 0.025)
+    assert breaker.state == OPEN
+    await asyncio.sleep(0.06)
+    await breaker.call(ctx, ok, 0.025)
+    assert breaker.state == OPEN
+    assert [name for name, _ in ctx._annotations][-4:] == [
+        'api circuit closed', 'api circuit open', 'api circuit half_open',
+        'api circuit open']
+
+
+async def test_circuit_breaker_standalone(loop):
+    app = Application(loop=loop)
+    ctx = app.tracer.new_trace()
+    breaker = CircuitBreaker(loop, app.tracer, 'db', min_calls=1)
+
+    async def fail():
+        raise ConnectionError()
+
+    with pytest.raises(ConnectionError):
+        await breaker.call(ctx, fail)
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        await breaker.call(ctx, fail)
+
+
+async def test_retry(loop):
+    app = Application(loop=loop)
+    spans = []
+    app.tracer.on_span_finish = spans.append
+    ctx = app.tracer.new_trace()
+    errors = [ConnectionError(), asyncio.TimeoutError()]
+
+    async def flaky(ctx, value):
+        if errors:
+            raise errors.pop(0)
+        return value, ctx
+
+    retry = Retry(loop, 'api', attempts=3, base_delay=0.01, multiplier=2,
+                  jitter=0)
+    assert [retry.backoff(n) for n in (1, 2, 3)] == [0.01, 0.02, 0.04]
+    start = loop.time()
+    value, attempt_ctx = await retry.call(ctx, flaky, 'ok')
+    assert value == 'ok'
+    assert loop.time() - start >= 0.03
+    attempts = [span for span in spans if span._name == 'api_attempt']
+    assert attempts[-1] is attempt_ctx
+    assert [span.parent for span in attempts] == [ctx] * 3
+    assert [(span._tags['retry.attempt'], span._tags['retry.delay'])
+            for span in attempts] == [('1', '0.0'), ('2', '0.01'),
+                                      ('3', '0.02')]
+    assert attempts[0]._tags['error'] == 'true'
+
+    errors[:] = [ConnectionError()] * 3
+    with pytest.raises(ConnectionError):
+        await retry.call(ctx, flaky, 'ok')
+    errors[:] = [ValueError()]
+    with pytest.raises(ValueError):
+        await retry.call(ctx, flaky, 'ok')
+    assert errors == []
+
+    # cancellation is not retried even when retrying on any error
+    calls = []
+
+    async def cancelled(ctx):
+        calls.append(ctx)
+        raise asyncio.CancelledError()
+
+    any_error = Retry(loop, 'api', attempts=3, base_delay=0.01,
+                      retry_on=(Exception,))
+    with pytest.raises(asyncio.CancelledError):
+        await any_error.call(ctx, cancelled)
+    assert len(calls) == 1
+
+    jittered = Retry(loop, base_delay=1., max_delay=2.)
+    assert all(0 < jittered.backoff(n) <= 2. for n in range(1, 10))
+
+
+async def test_retry_budget_deadline(loop):
+    app = Application(loop=loop)
+    ctx = app.tracer.new_trace()
+    budget = RetryBudget(loop, ratio=0.5, min_retries=1, window=0.1)
+    retry = Retry(loop, 'api', attempts=5, base_delay=0.001, budget=budget)
+    calls = []
+
+    async def fail(ctx):
+        calls.append(ctx)
+        raise ConnectionError()
+
+    # retries stay below 1 + half of the calls
+    with pytest.raises(ConnectionError):
+        await retry.call(ctx, fail)
+    assert (len(calls), budget.calls, budget.retries) == (3, 1, 2)
+    assert ctx._annotations[-1][0] == 'api retry budget exhausted'
+    with pytest.raises(ConnectionError):
+        await retry.call(ctx, fail)
+    assert (len(calls), budget.retries) == (4, 2)
+    await asyncio.sleep(0.11)
+    assert (budget.calls, budget.retries) == (0, 0)
+
+    async def slow(ctx):
+        calls.append(ctx)
+        await asyncio.sleep(1)
+
+    calls.clear()
+    retry = Retry(loop, 'api', attempts=5, base_delay=0.02, jitter=0,
+                  timeout=0.05)
+    start = loop.time()
+    with pytest.raises(asyncio.TimeoutError):
+        await retry.call(ctx, slow)
+    assert loop.time() - start < 0.1
+    assert len(calls) == 1
+    assert ctx._annotations[-1][0] == 'api retry after deadline'
+
+    calls.clear()
+    with pytest.raises(ConnectionError):
+        await retry.call(ctx, fail, deadline=loop.time() + 0.05)
+    # retried after 20 ms, the retry after 40 more ms would be too late
+    assert len(calls) == 2
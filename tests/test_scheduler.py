@@ -0,0 +1,77 @@
+import asyncio
+import datetime
+from aioapp.app import Application
+from aioapp.metrics import Registry
+from aioapp.scheduler import Scheduler
+
+
+async def test_scheduler(loop):
+    app = Application(loop=loop)
+    app.tracer.setup_registry()
+    fired = []
+
+    async def coro(name):
+        fired.append((name, loop.time()))
+
+    start = loop.time()
+    app.scheduler.call_later(0.05, lambda: fired.append(('b', loop.time())))
+    app.scheduler.call_later(datetime.timedelta(seconds=0.02), coro, 'a')
+    handle = app.scheduler.call_at(start + 0.03, fired.append, 'cancelled')
+    assert app.scheduler.pending == 3
+    handle.cancel()
+    handle.cancel()
+    assert handle.cancelled() and handle.done()
+    assert app.scheduler.pending == 2
+
+    await asyncio.sleep(0.1)
+    assert [name for name, _ in fired] == ['a', 'b']
+    assert fired[0][1] - start >= 0.02
+    assert fired[1][1] - start >= 0.05
+    assert app.scheduler.pending == 0
+    assert app.scheduler.stats()['fired'] == 2
+    assert app.scheduler.stats()['cancelled'] == 1
+    assert app.tracer.registry.gauges[
+        Registry.key('scheduler_pending')] == 0
+
+    handle = app.scheduler.call_later(10, fired.append, 'never')
+    await app.run_shutdown()
+    assert handle.cancelled()
+    assert app.scheduler.pending == 0
+
+
+async def test_scheduler_cascade(loop):
+    # level slots span 1, 4 and 16 ticks of 1 ms, so delays over 64 ms are
+    # beyond the wheel
+    scheduler = Scheduler(loop, resolution=0.001, bits=2, levels=3)
+    fired = []
+    start = loop.time()
+    delays = [0.001 * i for i in range(0, 120, 7)]
+    handles = [scheduler.call_later(delay, lambda delay=delay: fired.append(
+        (delay, loop.time()))) for delay in delays]
+    handles[3].cancel()
+    await asyncio.sleep(0.2)
+    assert [delay for delay, _ in fired] == delays[:3] + delays[4:]
+    for delay, stamp in fired:
+        assert stamp - start >= delay
+    assert scheduler.pending == 0
+    # empty ticks are skipped
+    assert scheduler.stats()['ticks'] < 60
+
+
+async def test_scheduler_error(loop):
+    scheduler = Scheduler(loop)
+    errors = []
+    fired = []
+    loop.set_exception_handler(lambda loop, context: errors.append(context))
+    try:
+        def fail():
+            other.cancel()
+            raise ZeroDivisionError()
+
+        scheduler.call_later(0.01, fail)
+        other = scheduler.call_later(0.01, fired.append, 1)
+        await asyncio.sleep(0.05)
+    finally:
+        loop.set_exception_handler(None)
+    assert fired == []
+    assert isinstance(errors[0]['exception'], ZeroDivisionError)
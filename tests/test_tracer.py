@@ -1,6 +1,13 @@
+import time
+import socket
+import asyncio
+import pytest
+from yarl import URL
 import aioapp.app
+import aioapp.tracer
 import aiozipkin.helpers as azh
 from aioapp.tracer import SERVER, CLIENT
+from .conftest import get_free_port
 
 
 async def test_tracer(app: aioapp.app.Application, tracer_server,
@@ -90,3 +97,352 @@ async def test_tracer_from_hdrs(request, app: aioapp.app.Application,
         assert req[0][0]['parentId'] == '5c639fc540090ee6'
     else:
         assert len(req) == 0
+
+
+async def test_profiler(app: aioapp.app.Application, tmpdir):
+    app.tracer.setup_profiler(0.05, interval=0.001, top=3,
+                              dump_dir=str(tmpdir))
+
+    def busy(duration):
+        stop = time.time() + duration
+        while time.time() < stop:
+            pass
+
+    with app.tracer.new_trace() as fast:
+        fast.name('fast').profile()
+
+    with app.tracer.new_trace() as slow:
+        slow.name('slow').profile()
+        busy(0.1)
+
+    with app.tracer.new_trace() as unmarked:
+        unmarked.name('unmarked')
+        busy(0.1)
+
+    await asyncio.sleep(0.05)
+    await app.tracer.close()
+
+    assert fast._annotations == []
+    assert unmarked._annotations == []
+    anns = [ann for ann, _ in slow._annotations]
+    assert 0 < len(anns) <= 3
+    assert all(ann.startswith('profile: ') for ann in anns)
+    assert any('busy' in ann for ann in anns)
+    assert tmpdir.join('%s.folded' % slow.trace_id).check()
+    assert app.tracer.profiler._thread is None
+
+
+async def test_trace_store(app: aioapp.app.Application):
+    app.tracer.setup_trace_store(size=3, max_names=2, buckets=[0.1, 1])
+    assert app.tracer.slowest_traces() == []
+
+    def trace(name, duration, skip=False, **tags):
+        span = app.tracer.new_trace(skip=skip)
+        span.name(name)
+        span.start(ts=100)
+        for key, value in tags.items():
+            span.new_child('child').tag(key, value).start(ts=100).finish(
+                ts=100 + duration)
+        span.finish(ts=100 + duration,
+                    exception=Exception() if name == 'err' else None)
+        return span
+
+    spans = [trace('a', 0.01 * i, user=str(i)) for i in range(5)]
+    slow = trace('a', 2)
+    err = trace('err', 0.5)
+    other = trace('other', 0.05)
+    trace('a', 5, skip=True)
+
+    assert app.tracer.slowest_traces(2) == [slow, err]
+    assert (app.tracer.slowest_traces(10, name='a')
+            == [slow, spans[4], spans[3]])
+    assert app.tracer.errored_traces() == [err]
+    assert app.tracer.errored_traces(name='a') == []
+    assert app.tracer.traces_with_tag('user', '4') == [spans[4]]
+    assert app.tracer.traces_with_tag('user', '0') == []  # evicted
+    assert len(app.tracer.traces_with_tag('user')) == 2
+    assert list(app.tracer.trace_store._by_name) == ['a', 'err', '__other__']
+    assert app.tracer.slowest_traces(10, name='__other__') == [other]
+
+    # the spans of a stored trace are capped breadth first
+    app.tracer.setup_trace_store(max_spans=4)
+    with app.tracer.new_trace() as big:
+        for _ in range(3):
+            with big.new_child() as child:
+                child.new_child().start().finish()
+    assert app.tracer.slowest_traces() == [big]
+    assert len(big._children) == 3
+    assert [len(child._children) for child in big._children] == [0] * 3
+    assert big._tags['trace.dropped_spans'] == '3'
+
+
+async def test_metrics_batching(loop, udp_receiver):
+    port, packets = udp_receiver
+    app = aioapp.app.Application(loop=loop)
+    app.setup_logging(metrics_driver='statsd-influx',
+                      metrics_addr='udp://127.0.0.1:%s' % port,
+                      metrics_name='test_',
+                      metrics_max_packet_size=200,
+                      metrics_flush_interval=0.05)
+    await asyncio.sleep(0.01)
+    for i in range(20):
+        with app.tracer.new_trace() as span:
+            span.name('batched')
+            span.metrics_tag('i', str(i))
+    await asyncio.sleep(0.1)
+    lines = [line for packet in packets
+             for line in packet.decode().splitlines()]
+    assert len(lines) == 20
+    assert 1 < len(packets) < 20
+    assert all(len(packet) <= 200 for packet in packets)
+
+    packets.clear()
+    with app.tracer.new_trace() as span:
+        span.name('last')
+    await app.tracer.close()
+    await asyncio.sleep(0.01)
+    assert len(packets) == 1
+    assert packets[0].startswith(b'test_last:')
+
+
+@pytest.mark.parametrize('driver', ['telegraf-influx', 'statsd-influx'])
+async def test_metrics_aggregate(loop, udp_receiver, driver):
+    port, packets = udp_receiver
+    app = aioapp.app.Application(loop=loop)
+    app.setup_logging(metrics_driver=driver,
+                      metrics_addr='udp://127.0.0.1:%s' % port,
+                      metrics_name='test_',
+                      metrics_aggregate=True,
+                      metrics_aggregate_interval=0.1)
+    await asyncio.sleep(0.01)
+    for i in range(1, 101):
+        span = app.tracer.new_trace()
+        span.name('agg').metrics_tag('tag', 'a b')
+        span.start(ts=100).finish(ts=100 + i / 1000000)
+    await asyncio.sleep(0.01)
+    assert packets == []
+
+    await asyncio.sleep(0.15)
+    lines = sorted(line for packet in packets
+                   for line in packet.decode().splitlines())
+    if driver == 'telegraf-influx':
+        assert len(lines) == 2
+        fields, stamp = lines[0].split(' ')[-2:]
+        assert lines[0].startswith('test_agg,tag=a\\ b ')
+        assert fields == ('count=100,sum=5050,min=1,max=100,'
+                          'p50=50,p90=90,p99=99')
+        int(stamp)
+        # the slowest span of the only non-empty bucket
+        assert lines[1] == ('test_agg_exemplar,tag=a\\ b,le=5000 '
+                            'trace_id="%s",value=100,sampled=false %s'
+                            '' % (span.trace_id, stamp))
+    else:
+        assert lines == ['test_agg.count,tag=a\\ b:100|c',
+                         'test_agg.max,tag=a\\ b:100|g',
+                         'test_agg.min,tag=a\\ b:1|g',
+                         'test_agg.p50,tag=a\\ b:50|g',
+                         'test_agg.p90,tag=a\\ b:90|g',
+                         'test_agg.p99,tag=a\\ b:99|g',
+                         'test_agg.sum,tag=a\\ b:5050|g']
+
+    packets.clear()
+    await app.tracer.close()
+    await asyncio.sleep(0.01)
+    assert packets == []
+
+
+@pytest.mark.parametrize('scheme', ['tcp', 'unix', 'unixgram'])
+async def test_metrics_transports(loop, tmpdir, scheme):
+    received = []
+
+    async def handle(reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            received.append(line)
+
+    class Receiver(asyncio.DatagramProtocol):
+        def datagram_received(self, data, addr):
+            received.extend(data.splitlines(keepends=True))
+
+    path = str(tmpdir.join('metrics.sock'))
+    if scheme == 'tcp':
+        port = get_free_port()
+        addr = 'tcp://127.0.0.1:%s' % port
+    else:
+        addr = '%s://%s' % (scheme, path)
+
+    app = aioapp.app.Application(loop=loop)
+    app.setup_logging(metrics_driver='statsd-influx', metrics_addr=addr,
+                      metrics_flush_interval=0.01)
+    metrics = app.tracer.metrics
+    # nothing listens yet, lines are kept until reconnect
+    with app.tracer.new_trace() as span:
+        span.name('before')
+    await asyncio.sleep(0.05)
+    assert metrics.transport is None
+    assert metrics._pending_size > 0
+
+    if scheme == 'tcp':
+        server = await asyncio.start_server(handle, '127.0.0.1', port,
+                                            loop=loop)
+    elif scheme == 'unix':
+        server = await asyncio.start_unix_server(handle, path, loop=loop)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        server, _ = await loop.create_datagram_endpoint(Receiver,
+                                                        sock=sock)
+    try:
+        await asyncio.sleep(0.3)
+        assert metrics.transport is not None
+        assert received and received[0].startswith(b'before:')
+
+        metrics.pause_writing()
+        with app.tracer.new_trace() as span:
+            span.name('paused')
+        await asyncio.sleep(0.05)
+        assert len(received) == 1
+        metrics.resume_writing()
+        with app.tracer.new_trace() as span:
+            span.name('after')
+        await app.tracer.close()
+        await asyncio.sleep(0.05)
+        assert [line.split(b':')[0] for line in received] == [
+            b'before', b'paused', b'after']
+    finally:
+        server.close()
+
+
+async def test_metrics_buffer_limit(loop):
+    app = aioapp.app.Application(loop=loop)
+    app.tracer.metrics = aioapp.tracer.InfluxMetrics(
+        app.tracer, URL('tcp://127.0.0.1:%s' % get_free_port()), None,
+        'statsd-influx', loop, max_packet_size=0, max_buffer_size=50)
+    for i in range(10):
+        with app.tracer.new_trace() as span:
+            span.name('line%s' % i)
+    metrics = app.tracer.metrics
+    assert metrics._pending_size <= 50
+    assert metrics._pending[-1][0].startswith(b'line9:')
+    assert not metrics._pending[0][0].startswith(b'line0:')
+    pending = len(metrics._pending)
+    await app.tracer.close()
+    assert metrics._reconnect_handle is None
+    stats = metrics.stats()
+    assert stats['lines_sent'] == 0
+    assert stats['lines_dropped'] == {'buffer_full': 10 - pending,
+                                      'closed': pending}
+    # spans finished after close are counted as well
+    with app.tracer.new_trace() as span:
+        span.name('late')
+    assert metrics.stats()['lines_dropped']['closed'] == pending + 1
+    assert 0 < stats['buffer_high_water'] <= 50 + len(b'line9:0|ms\n')
+
+
+async def test_metrics_series_key(loop):
+    app = aioapp.app.Application(loop=loop)
+    metrics = aioapp.tracer.InfluxMetrics(
+        app.tracer, URL('udp://127.0.0.1:%s' % get_free_port('udp')),
+        'test_', 'statsd-influx', loop, series_cache_size=2)
+    try:
+        key = metrics.series_key('a name', {'b': 'x,y', 'a': 'new\nline'})
+        assert key == ('test_a\\ name', 'a=newline,b=x\\,y')
+        assert metrics.series_key('a name', {'a': 'new\nline',
+                                             'b': 'x,y'}) is key
+        assert metrics.series_key('plain') == ('test_plain', '')
+        assert metrics.series_key('codes', {'code': 200, 'ok': True}) == (
+            'test_codes', 'code=200,ok=True')
+        assert len(metrics._series_cache) == 2
+        assert ('a name', (('a', 'new\nline'), ('b', 'x,y'))) not in \
+            metrics._series_cache
+    finally:
+        await metrics.close()
+
+
+async def test_metrics_tag_limit(loop):
+    app = aioapp.app.Application(loop=loop)
+    metrics = aioapp.tracer.InfluxMetrics(
+        app.tracer, URL('udp://127.0.0.1:%s' % get_free_port('udp')),
+        None, 'statsd-influx', loop, max_tag_values=2,
+        tag_limits={'unlimited': 1000})
+    try:
+        keys = [metrics.series_key('req', {'user': str(i)})
+                for i in range(5)]
+        assert keys[1] == ('req', 'user=1')
+        assert keys[2] == keys[4] == ('req', 'user=__other__')
+        assert len(metrics._series_cache) == 3
+        metrics.series_key('unlimited', {'user': '5'})
+        assert metrics.cardinality_overflow() == {'req': ['user']}
+    finally:
+        await metrics.close()
+
+
+@pytest.mark.parametrize('driver', ['telegraf-influx', 'statsd-influx'])
+async def test_metrics_stats(loop, udp_receiver, driver):
+    port, packets = udp_receiver
+    app = aioapp.app.Application(loop=loop)
+    app.setup_logging(metrics_driver=driver,
+                      metrics_addr='udp://127.0.0.1:%s' % port,
+                      metrics_name='test_')
+    metrics = app.tracer.metrics
+    await asyncio.sleep(0.01)
+    for i in range(3):
+        with app.tracer.new_trace() as span:
+            span.name('span')
+    metrics.flush()
+    await asyncio.sleep(0.01)
+    stats = metrics.stats()
+    assert stats['lines_sent'] == 3
+    assert stats['packets_sent'] == 1
+    assert stats['bytes_sent'] == len(packets[0])
+    assert stats['reconnects'] == 0
+
+    packets.clear()
+    metrics.send_stats()
+    metrics.flush()
+    await asyncio.sleep(0.01)
+    lines = packets[0].decode().splitlines()
+    if driver == 'telegraf-influx':
+        assert len(lines) == 1
+        assert lines[0].startswith('test_aioapp_metrics lines_sent=3,')
+        assert 'lines_dropped_buffer_full=0' in lines[0]
+    else:
+        assert 'test_aioapp_metrics.lines_sent:3|g' in lines
+        assert 'test_aioapp_metrics.reconnects:0|g' in lines
+    await app.tracer.close()
+    assert metrics._stats_handle is None
+
+
+@pytest.mark.parametrize('driver', ['telegraf-influx', 'statsd-influx'])
+async def test_metrics_sampling(loop, udp_receiver, driver):
+    port, packets = udp_receiver
+    app = aioapp.app.Application(loop=loop)
+    app.tracer.setup_metrics(driver, 'udp://127.0.0.1:%s' % port, None,
+                             sample_rate=0.25,
+                             sample_rates={'all': 1., 'none': 0.})
+    await asyncio.sleep(0.01)
+    for name in ('all', 'none', 'sampled'):
+        for i in range(400):
+            with app.tracer.new_trace() as span:
+                span.name(name)
+        app.tracer.metrics.flush()
+        await asyncio.sleep(0.01)
+    await app.tracer.close()
+    await asyncio.sleep(0.01)
+
+    lines = [line for packet in packets
+             for line in packet.decode().splitlines()]
+    by_name = {}
+    for line in lines:
+        by_name.setdefault(line.split(' ')[0].split(':')[0], []).append(line)
+    assert len(by_name['all']) == 400
+    assert 'none' not in by_name
+    assert 40 < len(by_name['sampled']) < 200
+    if driver == 'telegraf-influx':
+        assert ',weight=4.0 ' in by_name['sampled'][0]
+        assert 'weight' not in by_name['all'][0]
+    else:
+        assert by_name['sampled'][0].endswith('|ms|@0.25')
+        assert by_name['all'][0].endswith('|ms')